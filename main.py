@@ -1,29 +1,76 @@
 import argparse
 import asyncio
+import bisect
+import contextvars
+import datetime
+import gc
+import hashlib
+import http
 import json
 import logging
+import multiprocessing
 import os
 import random
 import re
+import signal
+import sqlite3
 import string
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from logging.handlers import RotatingFileHandler
+from contextlib import asynccontextmanager, contextmanager
 from random import choice
 from urllib.parse import unquote
 
 import python_socks
 from PyQt5.uic.Compiler.qobjectcreator import logger
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from telethon import TelegramClient, functions
-from telethon.errors import PhoneNumberInvalidError, ApiIdPublishedFloodError, ApiIdInvalidError
+from fastapi.responses import JSONResponse as BaseJSONResponse, StreamingResponse, PlainTextResponse, Response
+from starlette.routing import Match
+from telethon import TelegramClient, functions, types
+from telethon.crypto import AuthKey
+from telethon.errors import PhoneNumberInvalidError, ApiIdPublishedFloodError, ApiIdInvalidError, ChannelsTooMuchError, \
+    UsernameOccupiedError, UserNotParticipantError, ChannelPrivateError, UsernameInvalidError, \
+    UsernamePurchaseAvailableError
 from telethon.tl.functions.account import UpdateNotifySettingsRequest
-from telethon.tl.functions.channels import GetParticipantRequest
 from telethon.tl.functions.users import GetFullUserRequest
-from telethon.tl.types import InputPeerNotifySettings, NotificationSoundNone, InputBotAppShortName, User
+from telethon.tl.types import InputPeerNotifySettings, NotificationSoundNone, InputBotAppShortName, User, \
+    InputFolderPeer, Channel, InputChannel
+from telethon.sessions import MemorySession
+from telethon.sessions.memory import _SentFileType
+from telethon.tl.types.users import UserFull
+from telethon.utils import get_input_peer
 from unidecode import unidecode
 
 from openteleMain.src.api import UseCurrentSession
 from openteleMain.src.exception import OpenTeleException, TDesktopUnauthorized
-from openteleMain.src.td import TDesktop
+from openteleMain.src.td import TDesktop, MTP
+from openteleMain.src.tl import TelegramClient as TDesktopClient
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str).encode('utf-8')
+
+
+class JSONResponse(BaseJSONResponse):
+    def render(self, content) -> bytes:
+        return json_dumps(content)
 
 
 class ApiJsonError(Exception):
@@ -38,6 +85,10 @@ class SessionInvalidError(Exception):
     pass
 
 
+class DeadlineExceededError(Exception):
+    pass
+
+
 class UnknownError(Exception):
     status_code: int
     detail: str
@@ -47,7 +98,30 @@ class UnknownError(Exception):
         self.detail = detail
 
 
-app = FastAPI(debug=False)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sweeper = asyncio.create_task(client_pool.run_sweeper(CLIENT_POOL_SWEEP_INTERVAL))
+    flusher = asyncio.create_task(session_store.run_flusher()) if session_store.write_behind else None
+    lag_monitor = asyncio.create_task(monitor_event_loop(EVENT_LOOP_LAG_INTERVAL))
+    await job_queue.start()
+    for directory in layout_migrator.startup_directories:
+        layout_migrator.schedule(directory)
+    try:
+        yield
+    finally:
+        await job_queue.stop()
+        await prewarmer.stop()
+        await layout_migrator.stop()
+        sweeper.cancel()
+        lag_monitor.cancel()
+        await client_pool.close()
+        if flusher is not None:
+            flusher.cancel()
+            # disconnecting the pool marked the last changes, nothing may be left in memory
+            await session_store.flush()
+
+
+app = FastAPI(debug=False, lifespan=lifespan, default_response_class=JSONResponse)
 
 logging.getLogger('telethon').setLevel(logging.ERROR)
 logging.basicConfig(level=logging.INFO)
@@ -62,79 +136,182 @@ DEFAULT_MUTE_SETTINGS = InputPeerNotifySettings(
     silent=True,
     sound=NotificationSoundNone()
 )
+CLIENT_POOL_MAX_SIZE = 500
+CLIENT_POOL_IDLE_TTL = 300
+CLIENT_POOL_HEALTH_CHECK_AFTER = 60
+CLIENT_POOL_SWEEP_INTERVAL = 30
+BATCH_DEFAULT_CONCURRENCY = 20
+BATCH_MAX_CONCURRENCY = 200
+PREWARM_CONCURRENCY = 20
+PREWARM_DEFAULT_TTL = 10 * 60
+PREWARM_MAX_TTL = 2 * 60 * 60
+PROXY_MAX_IN_FLIGHT = 8
+PROXY_MAX_QUEUE = 200
+PROXY_QUEUE_TIMEOUT = 30
+PROXY_BREAKER_WINDOW = 60
+PROXY_BREAKER_MIN_FAILURES = 5
+PROXY_BREAKER_FAILURE_RATIO = 0.5
+PROXY_BREAKER_OPEN_TIME = 30
+PROXY_BREAKER_MAX_OPEN_TIME = 5 * 60
+ACCOUNT_STORE_PATH = "accounts.sqlite"
+PROFILE_CACHE_TTL = 60 * 60
+JOIN_RESOLVE_CONCURRENCY = 4
+JOIN_INTERVAL = 1.0
+CHANNEL_INDEX_TTL = 30 * 60
+CHANNEL_INDEX_MAX_SIZE = 10000
+USERNAME_CANDIDATES = 8
+USERNAME_CHECK_CONCURRENCY = 4
+TAKEN_USERNAME_TTL = 24 * 60 * 60
+TDATA_CACHE_MAX_SIZE = 20000
+SERVICES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "services.json")
+SERVICE_REGISTRY_RELOAD_INTERVAL = 5
+WEBVIEW_CACHE_MAX_AGE = 5 * 60
+WEBVIEW_CACHE_MAX_SIZE = 50000
+SESSION_STORE_PATH = "sessions.sqlite"
+SESSION_FLUSH_INTERVAL = 5
+SESSION_CACHE_MAX_SIZE = 10000
+EVENT_LOOP_LAG_INTERVAL = 0.5
+IMPORT_BATCH_SIZE = 5000
+IMPORT_PROGRESS_INTERVAL = 5
+LAYOUT_MIGRATION_BATCH = 500
+JOB_STORE_PATH = "jobs.sqlite"
+JOB_WORKERS = 32
+JOB_MAX_ATTEMPTS = 3
+JOB_MAX_WAIT = 60
+JOB_RESULT_TTL = 24 * 60 * 60
+JOB_POLL_INTERVAL = 5
+JOB_CLEANUP_INTERVAL = 60
+REQUEST_DEFAULT_TIMEOUT = 40
+REQUEST_MAX_TIMEOUT = 600
+DEADLINE_CONNECT_BUDGET = 1.0
+DEADLINE_RPC_BUDGET = 0.1
+TRACE_SLOW_THRESHOLD = 5.0
+TRACE_LOG_PATH = "slow_traces.log"
+TRACE_LOG_MAX_BYTES = 10 * 1024 * 1024
+TRACE_LOG_BACKUPS = 5
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40)
+PROFILE_BADGES = {
+    "diamond": "💎",
+    "cat": "🐈‍⬛",
+    "pixel": "▪️",
+    "paws": "🐾"
+}
+TRACE_ID_PATTERN = re.compile(r"[\w-]{1,64}")
+PROFILE_CHANGING_REQUESTS = (functions.account.UpdateProfileRequest, functions.account.UpdateUsernameRequest)
 
 
 @app.exception_handler(Exception)
 async def handle_exceptions(request: Request, e):
+    # the request trace is already closed here, its id is kept on the request
+    trace_id = getattr(request.state, 'trace_id', None)
+    response = exception_response(e, get_body_as_string(request), trace_id)
+    if trace_id is not None:
+        response.headers["X-Trace-Id"] = trace_id
+    return response
+
+
+def exception_response(e, body: str, trace_id=None):
+    status, detail = classify_exception(e)
+    if status == "proxy_error":
+        return proxy_error_handler(ProxyError(detail), body)
+    elif status == "session_invalid":
+        return session_invalid_error_handler(SessionInvalidError(detail), body)
+    elif status == "deadline_exceeded":
+        return deadline_exceeded_handler(DeadlineExceededError(detail), body)
+    elif status == "success":
+        return JSONResponse(
+            status_code=200,
+            content={"status": "success"},
+        )
+    elif isinstance(e, UnknownError):
+        return unknown_exception_handler(e, body)
+    else:
+        logger.error(f"Unexpected error (trace {trace_id}): {detail}")
+        return unknown_exception_handler(UnknownError(status_code=200, detail=detail), body)
+
+
+def classify_exception(e):
     string_exception = str(e)
+    # out of time, checked first since it is raised around proxy and rpc calls
+    if isinstance(e, DeadlineExceededError):
+        return "deadline_exceeded", string_exception
     # proxy error
-    if isinstance(e, ConnectionError) or "ConnectionError" in string_exception:
-        return proxy_error_handler(ProxyError("Failed to connect to proxy"), request)
+    elif isinstance(e, ConnectionError) or "ConnectionError" in string_exception:
+        return "proxy_error", "Failed to connect to proxy"
     elif isinstance(e, asyncio.TimeoutError):
-        return proxy_error_handler(ProxyError("Proxy connection timed out"), request)
+        return "proxy_error", "Proxy connection timed out"
     elif "The authorization key (session file) was used under two" in string_exception:
-        return proxy_error_handler(ProxyError("Session file was used under two different keys"), request)
+        return "proxy_error", "Session file was used under two different keys"
+    elif isinstance(e, ProxyError):
+        return "proxy_error", string_exception
     # session error
     elif isinstance(e, PhoneNumberInvalidError) or "The phone number is invalid" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
     elif isinstance(
             e, SessionInvalidError) or "SessionInvalidError" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
     elif isinstance(e,
                     OpenTeleException) or "OpenTeleException" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
     elif isinstance(e, ApiJsonError):
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
 
     elif isinstance(e,
                     TDesktopUnauthorized) or "TDesktopUnauthorized" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
     elif isinstance(e,
                     ApiIdPublishedFloodError) or "This API id w" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
     elif isinstance(e,
                     ApiIdInvalidError):
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
     elif "bytes read on a total" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
     elif "(caused by SendCodeRequest)" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
     elif "(caused by UpdateUsernameRequest)" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
+    elif "(caused by CheckUsernameRequest)" in string_exception:
+        return "session_invalid", string_exception
     elif "(caused by RequestWebViewRequest)" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
     elif "(caused by ResolveUsernameRequest)" in string_exception:
-        return session_invalid_error_handler(SessionInvalidError(string_exception), request)
+        return "session_invalid", string_exception
+    elif isinstance(e, UnknownError):
+        return "unknown_error", e.detail
     # ignore
     elif "JoinChannelRequest" in string_exception:
-        return JSONResponse(
-            status_code=200,
-            content={"status": "success"},
-        )
+        return "success", None
     # other errors
     else:
-        logger.error(f"Unexpected error: {string_exception}")
-        return unknown_exception_handler(UnknownError(status_code=200, detail=string_exception), request)
+        return "unknown_error", string_exception
+
+
+def proxy_error_handler(exc: ProxyError, body: str):
+    return JSONResponse(
+        status_code=200,
+        content={"status": "proxy_error", "detail": str(exc), "data": body},
+    )
 
 
-def proxy_error_handler(exc: ProxyError, request: Request):
+def session_invalid_error_handler(exc: SessionInvalidError, body: str):
     return JSONResponse(
         status_code=200,
-        content={"status": "proxy_error", "detail": str(exc), "data": get_body_as_string(request)},
+        content={"status": "session_invalid", "detail": str(exc), "data": body},
     )
 
 
-def session_invalid_error_handler(exc: SessionInvalidError, request: Request):
+def deadline_exceeded_handler(exc: DeadlineExceededError, body: str):
     return JSONResponse(
         status_code=200,
-        content={"status": "session_invalid", "detail": str(exc), "data": get_body_as_string(request)},
+        content={"status": "deadline_exceeded", "detail": str(exc), "data": body},
     )
 
 
-def unknown_exception_handler(exc: UnknownError, request: Request):
+def unknown_exception_handler(exc: UnknownError, body: str):
     return JSONResponse(
         status_code=exc.status_code,
-        content={"status": "unknown_error", "detail": exc.detail, "data": get_body_as_string(request)},
+        content={"status": "unknown_error", "detail": exc.detail, "data": body},
     )
 
 
@@ -143,7 +320,384 @@ def get_body_as_string(request: Request) -> str:
     return body.decode('utf-8')
 
 
-async def handle_bot_start(client, bot_name, referral_code):
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(zip(self.labels, key))} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, value, **labels):
+        # for counters that are kept elsewhere and only mirrored on scrape
+        self.values[self.key(labels)] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * len(self.buckets) + [0, 0.0]
+        position = bisect.bisect_left(self.buckets, value)
+        if position < len(self.buckets):
+            counts[position] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, counts in self.values.items():
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(labels + [('le', bucket)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(labels + [('le', '+Inf')])} {counts[-2]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {counts[-2]}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {counts[-1]}")
+        return lines
+
+
+def format_labels(labels):
+    labels = [f'{name}="{escape_label(value)}"' for name, value in labels]
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=()):
+        return self.register(Histogram(name, documentation, labels))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        # called on every scrape to refresh gauges that mirror other state
+        self.collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+REQUESTS_TOTAL = metrics.counter(
+    "session_service_requests_total", "HTTP requests by endpoint, service and outcome",
+    ("endpoint", "service", "outcome"))
+REQUEST_DURATION = metrics.histogram(
+    "session_service_request_duration_seconds", "HTTP request latency", ("endpoint", "service", "outcome"))
+REQUESTS_IN_FLIGHT = metrics.gauge(
+    "session_service_requests_in_flight", "HTTP requests being processed", ("endpoint",))
+OPERATION_DURATION = metrics.histogram(
+    "session_service_operation_duration_seconds", "Session operations, batch items and jobs included",
+    ("operation", "service", "outcome"))
+PHASE_DURATION = metrics.histogram(
+    "session_service_phase_duration_seconds", "Time spent in each phase of an operation",
+    ("phase", "service", "outcome"))
+RPC_DURATION = metrics.histogram(
+    "session_service_rpc_duration_seconds", "Telegram RPC latency by request type", ("rpc", "outcome"))
+EVENT_LOOP_LAG = metrics.histogram(
+    "session_service_event_loop_lag_seconds", "How late the event loop wakes up a sleeping task", ())
+PROXY_QUEUE_WAIT = metrics.histogram(
+    "session_service_proxy_queue_wait_seconds", "Time spent waiting for a proxy slot", ("proxy",))
+
+
+class Span:
+    def __init__(self, name, attributes, trace):
+        self.name = name
+        self.attributes = attributes
+        self.trace = trace or self
+        self.started = time.perf_counter()
+        self.finished = None
+        self.error = None
+        self.children = []
+
+    @property
+    def duration(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def child(self, name, attributes):
+        span = Span(name, attributes, self.trace)
+        self.children.append(span)
+        return span
+
+    def finish(self, error=None):
+        if self.finished is None:
+            self.finished = time.perf_counter()
+            self.error = error
+
+    def to_dict(self, origin=None):
+        origin = self.started if origin is None else origin
+        return {
+            "name": self.name,
+            "start": round((self.started - origin) * 1000, 3),
+            "duration": round(self.duration * 1000, 3),
+            **({"attributes": self.attributes} if self.attributes else {}),
+            **({"error": self.error} if self.error else {}),
+            **({"children": [child.to_dict(origin) for child in self.children]} if self.children else {}),
+        }
+
+
+class Tracer:
+    def __init__(self, path, slow_threshold):
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self._log = None
+
+    @contextmanager
+    def trace(self, name, trace_id=None, **attributes):
+        root = Span(name, {"traceId": trace_id or uuid.uuid4().hex, **attributes}, None)
+        token = current_span.set(root)
+        try:
+            yield root
+        except BaseException as e:
+            root.finish(span_error(e))
+            raise
+        finally:
+            current_span.reset(token)
+            root.finish()
+            if root.duration >= self.slow_threshold:
+                self.write(root)
+
+    def write(self, root):
+        try:
+            self.log.info(json_dumps({"time": time.time(), **root.to_dict()}).decode('utf-8'))
+        except Exception as e:
+            logger.error(f"Failed to write slow trace: {e}")
+
+    @property
+    def log(self):
+        if self._log is None:
+            handler = RotatingFileHandler(self.path, maxBytes=TRACE_LOG_MAX_BYTES, backupCount=TRACE_LOG_BACKUPS,
+                                          encoding='utf-8')
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._log = logging.getLogger("slow_traces")
+            self._log.setLevel(logging.INFO)
+            self._log.propagate = False
+            self._log.addHandler(handler)
+        return self._log
+
+
+current_span = contextvars.ContextVar("current_span", default=None)
+tracer = Tracer(TRACE_LOG_PATH, TRACE_SLOW_THRESHOLD)
+
+
+def current_trace_id():
+    span = current_span.get()
+    return span.trace.attributes["traceId"] if span is not None else None
+
+
+def span_error(e):
+    return f"{type(e).__name__}: {e}" if isinstance(e, Exception) else type(e).__name__
+
+
+def start_span(name, **attributes):
+    parent = current_span.get()
+    # tasks started by telethon keep the context of the request that connected the client
+    if parent is None or parent.trace.finished is not None:
+        return None
+    return parent.child(name, attributes)
+
+
+@contextmanager
+def trace_span(name, **attributes):
+    span = start_span(name, **attributes)
+    if span is None:
+        yield None
+        return
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.finish(span_error(e))
+        raise
+    finally:
+        current_span.reset(token)
+        span.finish()
+
+
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+def deadline_after(timeout):
+    if timeout is None:
+        timeout = REQUEST_DEFAULT_TIMEOUT
+    try:
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        raise UnknownError(400, f"Invalid request timeout: {timeout}")
+    if not timeout > 0:
+        raise UnknownError(400, f"Invalid request timeout: {timeout}")
+    return time.monotonic() + min(timeout, REQUEST_MAX_TIMEOUT)
+
+
+def remaining_budget():
+    deadline = request_deadline.get()
+    return deadline - time.monotonic() if deadline is not None else None
+
+
+def check_deadline(step, needed=0.0):
+    remaining = remaining_budget()
+    if remaining is not None and remaining <= needed:
+        raise DeadlineExceededError(f"Request deadline exceeded: {max(remaining, 0):.2f}s left for {step}")
+
+
+async def within_deadline(awaitable, step, needed=0.0, timeout=None):
+    try:
+        check_deadline(step, needed)
+    except DeadlineExceededError:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise
+    remaining = remaining_budget()
+    if remaining is not None:
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    if timeout is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout=timeout)
+    except asyncio.TimeoutError:
+        # only our own budget running out is a deadline, other timeouts keep their meaning
+        check_deadline(step)
+        raise
+
+
+async def monitor_event_loop(interval):
+    # anything that blocks the loop, such as synchronous disk writes, shows up as lag
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(time.perf_counter() - started - interval, 0))
+
+
+@contextmanager
+def observe_phase(phase, service=""):
+    started = time.perf_counter()
+    outcome = "success"
+    try:
+        with trace_span(phase, **({"service": service} if service else {})):
+            yield
+    except BaseException as e:
+        outcome = classify_exception(e)[0] if isinstance(e, Exception) else "cancelled"
+        raise
+    finally:
+        PHASE_DURATION.observe(time.perf_counter() - started, phase=phase, service=service, outcome=outcome)
+
+
+def instrument_client(client):
+    call = client._call
+
+    async def timed_call(sender, request, *args, **kwargs):
+        check_deadline(type(request).__name__, DEADLINE_RPC_BUDGET)
+        started = time.perf_counter()
+        outcome = "success"
+        try:
+            with trace_span(type(request).__name__):
+                return await call(sender, request, *args, **kwargs)
+        except BaseException as e:
+            outcome = classify_exception(e)[0] if isinstance(e, Exception) else "cancelled"
+            raise
+        finally:
+            RPC_DURATION.observe(time.perf_counter() - started, rpc=type(request).__name__, outcome=outcome)
+
+    client._call = timed_call
+    sender = client._sender
+    try_connect, try_gen_auth_key, send = sender._try_connect, sender._try_gen_auth_key, sender.send
+
+    async def traced_connect(attempt):
+        with trace_span("proxy_connect", attempt=attempt):
+            return await try_connect(attempt)
+
+    async def traced_gen_auth_key(attempt):
+        with trace_span("auth_key_exchange", attempt=attempt):
+            return await try_gen_auth_key(attempt)
+
+    def traced_send(request, *args, **kwargs):
+        future = send(request, *args, **kwargs)
+        # connect() sends initConnection straight through the sender, bypassing _call
+        if isinstance(request, functions.InvokeWithLayerRequest):
+            span = start_span("handshake")
+            if span is not None:
+                future.add_done_callback(lambda f: span.finish(
+                    None if f.cancelled() or f.exception() is None else span_error(f.exception())))
+        return future
+
+    sender._try_connect = traced_connect
+    sender._try_gen_auth_key = traced_gen_auth_key
+    sender.send = traced_send
+
+
+async def ensure_authorized(client):
+    if not client.is_connected():
+        with observe_phase("connect"):
+            await within_deadline(client.connect(), "connect", DEADLINE_CONNECT_BUDGET)
+    with observe_phase("auth_check"):
+        authorized = await client.is_user_authorized()
+    if not authorized:
+        raise SessionInvalidError()
+
+
+async def handle_bot_start(client, session_id, bot_name, referral_code):
+    if account_store.is_bot_started(session_id, bot_name):
+        return
     chat = await client.get_input_entity(bot_name)
     messages = await client.get_messages(chat, limit=1)
     if not len(messages):
@@ -151,6 +705,14 @@ async def handle_bot_start(client, bot_name, referral_code):
             await client.send_message(bot_name, '/start')
         else:
             await client.send_message(bot_name, '/start ' + referral_code)
+        account_store.save_bot_start(session_id, bot_name, referral_code or None)
+    else:
+        # started before the history was recorded, the referral code is unknown
+        account_store.save_bot_start(session_id, bot_name)
+
+
+def normalize_username(username):
+    return username.lstrip('@').lower()
 
 
 async def request_web_view(client, peer, bot, url, platform, referral_code=None):
@@ -203,8 +765,10 @@ async def request_app_web_view(client, bot_name, short_name, platform, referral_
 def process_data_and_proxy(data):
     if data['apiJson'] is None and data['sessionType'] == 'telethon':
         raise ApiJsonError()
-    if data['apiJson'] is not None:
-        data['apiJson'] = proccess_api_json(json.loads(data['apiJson']))
+    if isinstance(data['apiJson'], (str, bytes)):
+        data['apiJson'] = proccess_api_json(json_loads(data['apiJson']))
+    elif data['apiJson'] is not None:
+        data['apiJson'] = proccess_api_json(data['apiJson'])
     split_proxy = data['proxy'].split(':')
     proxy_dict = {
         "proxy_type": python_socks.ProxyType.SOCKS5 if split_proxy[0] == 'socks5' else python_socks.ProxyType.HTTP,
@@ -217,6 +781,44 @@ def process_data_and_proxy(data):
     return data, proxy_dict
 
 
+class SessionRequest:
+    def __init__(self, raw: bytes, data: dict, proxy_dict: dict, deadline: float = None):
+        self.raw = raw
+        self.data = data
+        self.proxy_dict = proxy_dict
+        self.deadline = deadline
+
+    @classmethod
+    def parse(cls, raw: bytes, timeout=None) -> "SessionRequest":
+        with trace_span("parse_body", size=len(raw)):
+            return cls.from_data(json_loads(raw), raw, timeout)
+
+    @classmethod
+    def from_data(cls, data: dict, raw: bytes = None, timeout=None) -> "SessionRequest":
+        if raw is None:
+            raw = json_dumps(data)
+        # the budget starts counting here, a timeout in the body wins over the header
+        deadline = deadline_after(data.get("timeout", timeout))
+        data, proxy_dict = process_data_and_proxy(data)
+        return cls(raw, data, proxy_dict, deadline)
+
+    @property
+    def session_id(self) -> str:
+        return str(self.data['id'])
+
+    @property
+    def api_json(self) -> dict:
+        return self.data['apiJson']
+
+
+def get_session_request(request: Request) -> SessionRequest:
+    session_request = getattr(request.state, 'session_request', None)
+    if session_request is None:
+        session_request = request.state.session_request = SessionRequest.parse(
+            request.state.body, request.headers.get("x-request-timeout"))
+    return session_request
+
+
 def proccess_api_json(api_json):
     if "app_id" in api_json:
         api_json["api_id"] = api_json["app_id"]
@@ -269,247 +871,1548 @@ def get_app_version():
     return choice(APP_VERSIONS) + " x64"
 
 
-async def _get_client(data, proxy_dict) -> TelegramClient:
-    if data['sessionType'] == 'tdata':
-        tdata = TDesktop(os.path.join(data['pathDirectory'], data['id']))
-        tdata.api.system_version = get_system_version()
-        tdata.api.app_version = get_app_version()
-        client = await tdata.ToTelethon(
-            os.path.join(data['pathDirectory'], str(data['id']) + '.session'),
-            api=tdata.api,
-            proxy=proxy_dict,
-            auto_reconnect=False,
-            connection_retries=0,
-            api_id=tdata.api.api_id,
-            api_hash=tdata.api.api_hash,
-            device_model=tdata.api.device_model,
-            system_version=tdata.api.system_version,
-            app_version=tdata.api.app_version,
-            lang_code=tdata.api.lang_code,
-            system_lang_code=tdata.api.system_lang_code,
-            receive_updates=False,
-            flag=UseCurrentSession
-        )
-        data["type"] = "telethon"
-        data['apiJson'] = proccess_api_json({
-            "api_id": tdata.api.api_id,
-            "api_hash": tdata.api.api_hash,
-            "device_model": tdata.api.device_model,
-            "device": tdata.api.device_model,
-            "system_version": tdata.api.system_version,
-            "app_version": tdata.api.app_version,
-            "system_lang_code": tdata.api.system_lang_code,
-            "app_version": tdata.api.app_version,
-            "lang_code": tdata.api.lang_code,
-            "lang_pack": tdata.api.lang_pack,
-            "pid": tdata.api.pid
-        })
+class AccountProfile:
+    def __init__(self, id, phone, username, premium, first_name, last_name, about=None, updated=None):
+        self.id = id
+        self.phone = phone
+        self.username = username
+        self.premium = premium
+        self.first_name = first_name
+        self.last_name = last_name
+        # None means the about text has not been fetched yet
+        self.about = about
+        self.updated = time.time() if updated is None else updated
+
+    @classmethod
+    def from_user(cls, user, about=None):
+        return cls(user.id, user.phone, user.username, bool(user.premium), user.first_name, user.last_name, about)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "phone": self.phone,
+            "username": self.username,
+            "premium": self.premium,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "about": self.about,
+            "updated": self.updated
+        }
+
+
+class AccountStore:
+    def __init__(self, path, profile_ttl, taken_username_ttl):
+        self.path = path
+        self.profile_ttl = profile_ttl
+        self.taken_username_ttl = taken_username_ttl
+        self.profiles = {}
+        self.started_bots = {}
+        self.taken_usernames = {}
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS profiles (session_id TEXT PRIMARY KEY, profile TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS bot_starts ("
+                             "session_id TEXT, bot TEXT, referral_code TEXT, started REAL, "
+                             "PRIMARY KEY (session_id, bot))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS taken_usernames (username TEXT PRIMARY KEY, checked REAL)")
+        return self._db
+
+    def get_profile(self, session_id, with_about=False):
+        session_id = str(session_id)
+        profile = self.profiles.get(session_id)
+        if profile is None:
+            row = self.db.execute("SELECT profile FROM profiles WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            profile = self.profiles[session_id] = AccountProfile(**json.loads(row[0]))
+        if time.time() - profile.updated > self.profile_ttl:
+            self.invalidate_profile(session_id)
+            return None
+        if with_about and profile.about is None:
+            return None
+        return profile
+
+    def save_profile(self, session_id, user, about=None):
+        session_id = str(session_id)
+        profile = AccountProfile.from_user(user, about)
+        cached = self.profiles.get(session_id)
+        if about is None and cached is not None:
+            profile.about = cached.about
+        if cached is not None and {**cached.to_dict(), "updated": profile.updated} == profile.to_dict() \
+                and profile.updated - cached.updated < self.profile_ttl / 2:
+            return cached
+        self.profiles[session_id] = profile
+        self.db.execute("INSERT OR REPLACE INTO profiles (session_id, profile) VALUES (?, ?)",
+                        (session_id, json.dumps(profile.to_dict(), ensure_ascii=False)))
+        return profile
+
+    def invalidate_profile(self, session_id):
+        session_id = str(session_id)
+        self.profiles.pop(session_id, None)
+        self.db.execute("DELETE FROM profiles WHERE session_id = ?", (session_id,))
+
+    def is_username_taken(self, username):
+        username = normalize_username(username)
+        checked = self.taken_usernames.get(username)
+        if checked is None:
+            row = self.db.execute("SELECT checked FROM taken_usernames WHERE username = ?", (username,)).fetchone()
+            if row is None:
+                return False
+            checked = self.taken_usernames[username] = row[0]
+        return time.time() - checked < self.taken_username_ttl
+
+    def save_username_taken(self, username):
+        username = normalize_username(username)
+        self.taken_usernames[username] = time.time()
+        self.db.execute("INSERT OR REPLACE INTO taken_usernames (username, checked) VALUES (?, ?)",
+                        (username, self.taken_usernames[username]))
+
+    def get_started_bots(self, session_id):
+        session_id = str(session_id)
+        bots = self.started_bots.get(session_id)
+        if bots is None:
+            rows = self.db.execute("SELECT bot, referral_code FROM bot_starts WHERE session_id = ?", (session_id,))
+            bots = self.started_bots[session_id] = dict(rows.fetchall())
+        return bots
+
+    def is_bot_started(self, session_id, bot):
+        return normalize_username(bot) in self.get_started_bots(session_id)
+
+    def save_bot_start(self, session_id, bot, referral_code=None):
+        bot = normalize_username(bot)
+        self.get_started_bots(session_id)[bot] = referral_code
+        self.db.execute("INSERT OR REPLACE INTO bot_starts (session_id, bot, referral_code, started) "
+                        "VALUES (?, ?, ?, ?)", (str(session_id), bot, referral_code, time.time()))
+
+
+account_store = AccountStore(ACCOUNT_STORE_PATH, PROFILE_CACHE_TTL, TAKEN_USERNAME_TTL)
+
+
+def find_self_user(result):
+    if isinstance(result, User):
+        users = [result]
+    elif isinstance(result, list):
+        users = result
     else:
-        for i in range(0, 4):
+        users = getattr(result, 'users', None) or []
+    for user in users:
+        if isinstance(user, User) and user.is_self and not user.min:
+            return user
+    return None
+
+
+def watch_self_user(client, session_id):
+    call = client._call
+
+    async def watched_call(sender, request, *args, **kwargs):
+        if isinstance(request, PROFILE_CHANGING_REQUESTS):
+            account_store.invalidate_profile(session_id)
+        result = await call(sender, request, *args, **kwargs)
+        user = find_self_user(result)
+        if user is not None:
+            about = None
+            if isinstance(request, functions.account.UpdateProfileRequest):
+                about = request.about
+            elif isinstance(result, UserFull) and result.full_user.id == user.id:
+                about = result.full_user.about or ""
+            account_store.save_profile(session_id, user, about)
+        return result
+
+    # every RPC of the client, get_me() included, goes through _call
+    client._call = watched_call
+
+
+async def get_profile(client, data, with_about=False) -> AccountProfile:
+    profile = account_store.get_profile(data['id'], with_about)
+    if profile is not None:
+        return profile
+    if with_about:
+        full = await client(GetFullUserRequest('me'))
+        return account_store.save_profile(data['id'], find_self_user(full), full.full_user.about or "")
+    return account_store.save_profile(data['id'], await client.get_me())
+
+
+def read_legacy_session(path):
+    # old telethon files differ in columns, only what every version has is read
+    legacy = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        tables = {name for name, in legacy.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        state = legacy.execute("SELECT dc_id, server_address, port, auth_key, takeout_id FROM sessions").fetchone()
+        if state is None:
+            return None
+        entities = legacy.execute("SELECT id, hash, username, phone, name FROM entities").fetchall() \
+            if "entities" in tables else []
+        states = legacy.execute("SELECT id, pts, qts, date, seq FROM update_state").fetchall() \
+            if "update_state" in tables else []
+        files = legacy.execute("SELECT md5_digest, file_size, type, id, hash FROM sent_files").fetchall() \
+            if "sent_files" in tables else []
+    finally:
+        legacy.close()
+    return state, entities, states, files
+
+
+class SessionStore:
+    def __init__(self, path, write_behind, flush_interval, cache_size):
+        self.path = path
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.imported = 0
+        # write-behind mode keeps sessions in memory and flushes them from a thread
+        self.sessions = OrderedDict()
+        self.dirty = set()
+        self.pending = []
+        # ids whose changes were taken from the session but are not on disk yet
+        self.unflushed = set()
+        self.flushes = 0
+        self.flushed = 0
+        self.write_lock = threading.Lock()
+        self._db = None
+        self._write_db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                             "session_id TEXT PRIMARY KEY, dc_id INTEGER, server_address TEXT, port INTEGER, "
+                             "auth_key BLOB, takeout_id INTEGER, updated REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS entities ("
+                             "session_id TEXT, id INTEGER, hash INTEGER NOT NULL, username TEXT, phone INTEGER, "
+                             "name TEXT, date INTEGER, PRIMARY KEY (session_id, id))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS update_state ("
+                             "session_id TEXT, id INTEGER, pts INTEGER, qts INTEGER, date INTEGER, seq INTEGER, "
+                             "PRIMARY KEY (session_id, id))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sent_files ("
+                             "session_id TEXT, md5_digest BLOB, file_size INTEGER, type INTEGER, id INTEGER, "
+                             "hash INTEGER, PRIMARY KEY (session_id, md5_digest, file_size, type))")
+        return self._db
+
+    @property
+    def write_db(self):
+        # writes get their own connection, WAL lets the event loop keep reading meanwhile
+        if self._write_db is None:
+            self.db
+            self._write_db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._write_db.execute("PRAGMA synchronous=NORMAL")
+        return self._write_db
+
+    def session(self, session_id, legacy_path=None) -> "SharedSession":
+        session_id = str(session_id)
+        session = self.sessions.get(session_id)
+        if session is not None:
+            self.sessions.move_to_end(session_id)
+            return session
+        session = SharedSession(self, session_id)
+        if not self.load(session) and legacy_path is not None:
+            # the old file is only looked for when the store has nothing for this session
+            path = legacy_path()
+            if os.path.exists(path):
+                self.import_legacy(session, path)
+            else:
+                # nothing signs accounts in here, a key made up by connect() is never authorized and a row
+                # saved for it would hide the session file once it appears
+                session.transient = True
+                return session
+        if self.write_behind:
+            self.sessions[session_id] = session
+            self._evict()
+        return session
+
+    def _evict(self):
+        # the object is the only copy of unflushed state, loading the row again would bring back an old auth key
+        while len(self.sessions) > self.cache_size:
+            key = next((key for key, cached in self.sessions.items()
+                        if cached not in self.dirty and key not in self.unflushed), None)
+            if key is None:
+                return
+            self.sessions.pop(key)
+
+    def load(self, session):
+        row = self.db.execute("SELECT dc_id, server_address, port, auth_key, takeout_id FROM sessions "
+                              "WHERE session_id = ?", (session.session_id,)).fetchone()
+        if row is None:
+            return False
+        dc_id, server_address, port, auth_key, takeout_id = row
+        session.load(dc_id, server_address, port, auth_key, takeout_id,
+                     self.db.execute("SELECT id, hash, username, phone, name FROM entities WHERE session_id = ?",
+                                     (session.session_id,)).fetchall(),
+                     self.db.execute("SELECT id, pts, qts, date, seq FROM update_state WHERE session_id = ?",
+                                     (session.session_id,)).fetchall(),
+                     self.db.execute("SELECT md5_digest, file_size, type, id, hash FROM sent_files "
+                                     "WHERE session_id = ?", (session.session_id,)).fetchall())
+        return True
+
+    def import_legacy(self, session, path):
+        legacy = read_legacy_session(path)
+        if legacy is None:
+            return
+        state, entities, states, files = legacy
+        session.load(*state, entities, states, files, dirty=True)
+        session.save()
+        self.imported += 1
+
+    def save(self, session):
+        if session.transient:
+            return
+        if self.write_behind:
+            self.dirty.add(session)
+            return
+        changes = session.take_changes()
+        if changes is None:
+            return
+        self.write([changes])
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
             try:
-                client = TelegramClient(
-                    session=os.path.join(data['pathDirectory'], data['id']) + ".session",
-                    api_id=data['apiJson']['api_id'],
-                    api_hash=data['apiJson']['api_hash'],
-                    device_model=data['apiJson']['device_model'],
-                    system_version=data['apiJson']['system_version'],
-                    app_version=data['apiJson']['app_version'],
-                    lang_code=data['apiJson']['lang_code'],
-                    receive_updates=False,
-                    proxy=proxy_dict,
-                    auto_reconnect=False,
-                    connection_retries=0
-                )
-                break
+                await self.flush()
             except Exception as e:
-                if i == 2:
-                    raise e
-                await asyncio.sleep(0.4)
+                logger.error(f"Session flush failed: {e}")
+
+    async def flush(self):
+        dirty, self.dirty = self.dirty, set()
+        # changes are collected on the loop, where sessions are modified, and written in a thread
+        changes = self.pending + [changes for changes in (session.take_changes() for session in dirty)
+                                  if changes is not None]
+        self.pending = []
+        if not changes:
+            return
+        self.unflushed = {session_id for session_id, *_ in changes}
+        try:
+            await asyncio.to_thread(self.write, changes)
+        except BaseException:
+            self.pending = changes + self.pending
+            raise
+        self.unflushed = set()
+        self._evict()
+        self.flushes += 1
+        self.flushed += len(changes)
+
+    def write(self, changes):
+        with self.write_lock:
+            self._write(changes)
+
+    def _write(self, changes):
+        db = self.write_db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for session_id, state, entities, states, files in changes:
+                if state is not None:
+                    db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (session_id, *state, time.time()))
+                db.executemany("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               [(session_id, *row, int(time.time())) for row in entities])
+                db.executemany("INSERT OR REPLACE INTO update_state VALUES (?, ?, ?, ?, ?, ?)",
+                               [(session_id, *row) for row in states])
+                db.executemany("INSERT OR REPLACE INTO sent_files VALUES (?, ?, ?, ?, ?, ?)",
+                               [(session_id, *row) for row in files])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def delete(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        self.dirty.discard(session)
+        with self.write_lock:
+            for table in ("sessions", "entities", "update_state", "sent_files"):
+                self.write_db.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+
+    def stats(self):
+        return {
+            "sessions": self.db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+            "imported": self.imported,
+            "writeBehind": self.write_behind,
+            "cached": len(self.sessions),
+            "dirty": len(self.dirty),
+            "pending": len(self.pending),
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+        }
+
+
+class SharedSession(MemorySession):
+    def __init__(self, store, session_id):
+        super().__init__()
+        self.store = store
+        self.session_id = session_id
+        self.transient = False
+        # one row per entity id, MemorySession keeps stale duplicates in a set
+        self._entity_rows = {}
+        self._entities = self._entity_rows.values()
+        self._dirty = False
+        self._dirty_entities = {}
+        self._dirty_states = {}
+        self._dirty_files = {}
+
+    def load(self, dc_id, server_address, port, auth_key, takeout_id, entities, states, files, dirty=False):
+        self._dc_id, self._server_address, self._port, self._takeout_id = dc_id or 0, server_address, port, takeout_id
+        self._auth_key = AuthKey(data=auth_key) if auth_key else None
+        for row in entities:
+            self._entity_rows[row[0]] = tuple(row)
+        for entity_id, pts, qts, date, seq in states:
+            self._update_states[entity_id] = types.updates.State(
+                pts, qts, datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc), seq, unread_count=0)
+        for md5_digest, file_size, file_type, file_id, file_hash in files:
+            self._files[(md5_digest, file_size, _SentFileType(file_type))] = (file_id, file_hash)
+        if dirty:
+            self._dirty = True
+            self._dirty_entities.update(self._entity_rows)
+            self._dirty_states.update(self._update_states)
+            self._dirty_files.update(self._files)
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._dirty = True
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._dirty = True
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._dirty = True
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        self._dirty_states[entity_id] = state
+
+    def process_entities(self, tlo):
+        for row in self._entities_to_rows(tlo):
+            if self._entity_rows.get(row[0]) != row:
+                self._entity_rows[row[0]] = row
+                self._dirty_entities[row[0]] = row
+
+    def cache_file(self, md5_digest, file_size, instance):
+        super().cache_file(md5_digest, file_size, instance)
+        key = (md5_digest, file_size, _SentFileType.from_type(type(instance)))
+        self._dirty_files[key] = self._files[key]
+
+    def take_changes(self):
+        if not (self._dirty or self._dirty_entities or self._dirty_states or self._dirty_files):
+            return None
+        state = (self._dc_id, self._server_address, self._port,
+                 self._auth_key.key if self._auth_key else None, self._takeout_id) if self._dirty else None
+        changes = (
+            self.session_id,
+            state,
+            list(self._dirty_entities.values()),
+            [(entity_id, state.pts, state.qts, int(state.date.timestamp()), state.seq)
+             for entity_id, state in self._dirty_states.items()],
+            [(md5_digest, file_size, file_type.value, *value)
+             for (md5_digest, file_size, file_type), value in self._dirty_files.items()],
+        )
+        self._dirty = False
+        self._dirty_entities, self._dirty_states, self._dirty_files = {}, {}, {}
+        return changes
 
-    return client
+    def save(self):
+        self.store.save(self)
 
+    def close(self):
+        self.save()
 
-async def set_username_if_not_exists(client, me=None):
-    if me is None:
-        me = await client.get_me()
-    if me.username is None:
-        try:
-            username = generate_username(me.first_name, me.last_name)
-            await client(functions.account.UpdateUsernameRequest(username))
-            me = await client.get_me()
-            if me.username is None:
-                raise Exception("Username not set")
-            return
-        except:
-            try:
-                username = generate_username(me.first_name, me.last_name, numbersRange=[0, 99])
-                await client(functions.account.UpdateUsernameRequest(username))
-                me = await client.get_me()
-                if me.username is None:
-                    raise Exception("Username not set")
-                return
-            except:
-                try:
-                    username = generate_username()
-                    await client(functions.account.UpdateUsernameRequest(username))
-                    me = await client.get_me()
-                    if me.username is None:
-                        raise Exception("Username not set")
-                    return
-                except:
-                    username = generate_username(numbersRange=[1000, 100000000])
-                    await client(functions.account.UpdateUsernameRequest(username))
-                    me = await client.get_me()
-                    if me.username is None:
-                        raise Exception("Username not set")
-                    return
+    def delete(self):
+        self.store.delete(self.session_id)
 
 
-async def _get_blum(client, data):
-    return await request_web_view(client, 'BlumCryptoBot', 'BlumCryptoBot', "https://telegram.blum.codes/",
-                                  data.get("tgIdentification"),
-                                  data.get("referralCode"))
+session_store = SessionStore(SESSION_STORE_PATH, False, SESSION_FLUSH_INTERVAL, SESSION_CACHE_MAX_SIZE)
 
 
-async def _get_iceberg(client, data):
-    await handle_bot_start(client, 'IcebergAppBot', data.get("referralCode"))
-    return await request_web_view(client, 'IcebergAppBot', 'IcebergAppBot', 'https://0xiceberg.com/webapp/',
-                                  data.get("tgIdentification"), None)
+def sharded_path(directory, session_id, suffix=""):
+    # two levels of 256 directories keep every directory small, ab/cd/<id>
+    digest = hashlib.blake2b(str(session_id).encode('utf-8'), digest_size=2).hexdigest()
+    return os.path.join(directory, digest[:2], digest[2:], f"{session_id}{suffix}")
 
 
-async def _get_tapswap(client, data):
-    await handle_bot_start(client, 'tapswap_bot', data.get("referralCode"))
-    return await request_web_view(client, 'tapswap_bot', 'tapswap_bot', 'https://app.tapswap.club/',
-                                  data.get("tgIdentification"), None)
+def account_path(directory, session_id, suffix="", create=False):
+    path = sharded_path(directory, session_id, suffix)
+    if os.path.exists(path):
+        return path
+    flat = os.path.join(directory, f"{session_id}{suffix}")
+    if os.path.exists(flat):
+        # not migrated yet, the directory gets migrated in the background
+        layout_migrator.schedule(directory)
+        return flat
+    if create:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
 
 
-async def _get_banana(client, data):
-    referral_code = None
-    if data["referralCode"] is not None:
-        referral_code = "referral=" + data["referralCode"]
-    return await request_app_web_view(client, 'OfficialBananaBot', 'banana', data.get("tgIdentification"),
-                                      referral_code)
+class LayoutMigrator:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.startup_directories = []
+        self.directories = set()
+        self.tasks = set()
+        self.moved = 0
+        self.skipped = 0
+        self.failed = 0
 
+    def schedule(self, directory):
+        directory = os.path.abspath(directory)
+        # one pass per directory and process, whatever it could not move stays reachable by its flat path
+        if directory in self.directories:
+            return
+        self.directories.add(directory)
+        task = asyncio.create_task(self.migrate(directory))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
-async def _get_clayton(client, data):
-    return await request_app_web_view(client, 'claytoncoinbot', 'game', data.get("tgIdentification"),
-                                      data.get("referralCode"))
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
 
+    async def migrate(self, directory):
+        try:
+            names = await asyncio.to_thread(self.flat_entries, directory)
+            owned = [(name, session_id) for name, session_id in names if session_shard(session_id) == worker_index]
+            self.skipped += len(names) - len(owned)
+            for start in range(0, len(owned), self.batch_size):
+                await asyncio.gather(*(self.claim_and_move(directory, name, session_id)
+                                       for name, session_id in owned[start:start + self.batch_size]))
+            logger.info(f"Migrated {directory} to the sharded layout")
+        except Exception as e:
+            logger.error(f"Layout migration of {directory} failed: {e}")
+
+    @staticmethod
+    def flat_entries(directory):
+        names = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".session") and entry.is_file():
+                    names.append((entry.name, entry.name[:-len(".session")]))
+                elif entry.is_dir() and os.path.exists(os.path.join(entry.path, "key_datas")):
+                    names.append((entry.name, entry.name))
+        return names
+
+    async def claim_and_move(self, directory, name, session_id):
+        # every request reads the files under the session's flight lock, the rename takes the same lock
+        # so nothing is moved from under a request that already resolved the flat path
+        await session_flights.run(session_id, ("layout", directory),
+                                  lambda: asyncio.to_thread(self.move, directory, name, session_id))
+
+    def move(self, directory, name, session_id):
+        suffix = name[len(session_id):]
+        # sqlite leaves journals next to a .session file, they belong to it
+        for extra in ("", "-journal", "-wal", "-shm") if suffix else ("",):
+            source = os.path.join(directory, name + extra)
+            target = sharded_path(directory, session_id, suffix + extra)
+            if not os.path.lexists(source):
+                continue
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if os.path.lexists(target):
+                    raise FileExistsError(target)
+                os.rename(source, target)
+                self.moved += not extra
+            except OSError as e:
+                self.failed += 1
+                logger.error(f"Failed to move {source}: {e}")
+
+    def stats(self):
+        return {"running": len(self.tasks), "moved": self.moved, "skipped": self.skipped, "failed": self.failed}
+
+
+layout_migrator = LayoutMigrator(LAYOUT_MIGRATION_BATCH)
+
+
+def find_accounts(root):
+    accounts = {}
+    for directory, directories, files in os.walk(root):
+        if "key_datas" in files:
+            # a tdata folder is either <id>/ itself or <id>/tdata/
+            name = os.path.basename(directory)
+            if name == "tdata":
+                name = os.path.basename(os.path.dirname(directory))
+            accounts.setdefault(name, ("tdata", directory))
+            directories.clear()
+            continue
+        for file in files:
+            if file.endswith(".session"):
+                accounts.setdefault(file[:-len(".session")], ("telethon", os.path.join(directory, file)))
+    return [(session_id, session_type, path) for session_id, (session_type, path) in accounts.items()]
 
-async def _get_cats(client, data):
-    return await request_app_web_view(client, 'catsgang_bot', 'join', data.get("tgIdentification"),
-                                      data.get("referralCode"))
 
+def decode_account(account):
+    session_id, session_type, path = account
+    try:
+        if session_type == "telethon":
+            legacy = read_legacy_session(path)
+            if legacy is None:
+                raise ValueError("session file has no auth key")
+            state, entities, states, files = legacy
+            return session_id, (session_id, state, entities, states, files), None
+        # the same endpoint choice as ToTelethon, without building a client
+        account = TDesktop(path).mainAccount
+        endpoint = account._local.config.endpoints(account.MainDcId)[
+            MTP.DcOptions.Address.IPv4][MTP.DcOptions.Protocol.Tcp][0]
+        state = (endpoint.id, endpoint.ip, endpoint.port, account.authKey.key, None)
+        return session_id, (session_id, state, [], [], []), None
+    # opentele errors derive from BaseException and would kill the pool worker
+    except (Exception, OpenTeleException) as e:
+        return session_id, None, f"{type(e).__name__}: {e}"
+
+
+def import_accounts(root, processes, batch_size):
+    started = time.monotonic()
+    accounts = find_accounts(root)
+    # everything committed by an earlier run is skipped, an interrupted import just starts again
+    existing = {session_id for session_id, in session_store.db.execute("SELECT session_id FROM sessions")}
+    pending = [account for account in accounts if account[0] not in existing]
+    logger.info(f"Found {len(accounts)} accounts in {root}, {len(accounts) - len(pending)} already imported")
+    imported, failed, batch = 0, 0, []
+    report_at = time.monotonic() + IMPORT_PROGRESS_INTERVAL
+
+    def report():
+        elapsed = time.monotonic() - started
+        logger.info(f"Imported {imported}/{len(pending)}, failed {failed}, "
+                    f"{(imported + failed) / elapsed:.0f} accounts/s, {elapsed:.0f}s")
+
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        for session_id, changes, error in pool.imap_unordered(decode_account, pending, chunksize=64):
+            if error is not None:
+                failed += 1
+                logger.warning(f"Failed to import {session_id}: {error}")
+            else:
+                batch.append(changes)
+            if len(batch) >= batch_size:
+                session_store.write(batch)
+                imported += len(batch)
+                batch = []
+            if time.monotonic() >= report_at:
+                report()
+                report_at = time.monotonic() + IMPORT_PROGRESS_INTERVAL
+    if batch:
+        session_store.write(batch)
+        imported += len(batch)
+    report()
+    return failed
+
+
+class TDesktopAuth:
+    def __init__(self, signature, api, session, user_id):
+        self.signature = signature
+        self.api = api
+        self.dc_id = session.dc_id
+        self.server_address = session.server_address
+        self.port = session.port
+        self.auth_key = session.auth_key.key
+        self.user_id = user_id
+
+    def session(self, session_id) -> "SharedSession":
+        # entities and update state live in the store, the cached key only fills in what is missing there
+        session = session_store.session(session_id)
+        if (session.dc_id, session.server_address, session.port) != (self.dc_id, self.server_address, self.port):
+            session.set_dc(self.dc_id, self.server_address, self.port)
+        if session.auth_key is None or session.auth_key.key != self.auth_key:
+            session.auth_key = AuthKey(self.auth_key)
+        return session
+
+
+class TDesktopCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def client(self, path, session_id, proxy_dict):
+        signature = self.signature(path)
+        auth = self.entries.get(path)
+        if auth is not None and signature is not None and auth.signature == signature:
+            self.hits += 1
+            self.entries.move_to_end(path)
+            api = auth.api.copy()
+            api.system_version = get_system_version()
+            api.app_version = get_app_version()
+            client = TDesktopClient(auth.session(session_id), api=api, **tdata_client_kwargs(api, proxy_dict))
+            client.UserId = auth.user_id
+            return client, api
+
+        self.misses += 1
+        # key derivation and decryption are cpu bound, keep them off the event loop
+        tdata = await asyncio.to_thread(TDesktop, path)
+        tdata.api.system_version = get_system_version()
+        tdata.api.app_version = get_app_version()
+        # the converted session goes to the shared store, later telethon requests find it there
+        client = await tdata.ToTelethon(
+            session_store.session(session_id),
+            api=tdata.api,
+            flag=UseCurrentSession,
+            **tdata_client_kwargs(tdata.api, proxy_dict)
+        )
+        if signature is not None:
+            self.entries[path] = TDesktopAuth(signature, tdata.api, client.session, client.UserId)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return client, tdata.api
+
+    @staticmethod
+    def signature(path):
+        # Telegram Desktop replaces its files when it writes them, stat is enough to notice
+        try:
+            directory = os.stat(path)
+            with os.scandir(path) as entries:
+                files = sorted((entry.name, entry.inode(), entry.stat().st_mtime_ns, entry.stat().st_size)
+                               for entry in entries if entry.is_file())
+        except OSError:
+            return None
+        return directory.st_ino, directory.st_mtime_ns, tuple(files)
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+tdata_cache = TDesktopCache(TDATA_CACHE_MAX_SIZE)
+
+
+def tdata_client_kwargs(api, proxy_dict):
+    return {
+        "proxy": proxy_dict,
+        "auto_reconnect": False,
+        "connection_retries": 0,
+        "api_id": api.api_id,
+        "api_hash": api.api_hash,
+        "device_model": api.device_model,
+        "system_version": api.system_version,
+        "app_version": api.app_version,
+        "lang_code": api.lang_code,
+        "system_lang_code": api.system_lang_code,
+        "receive_updates": False,
+    }
 
-async def _get_major(client, data):
-    return await request_app_web_view(client, 'major', 'start', data.get("tgIdentification"), data.get("referralCode"))
 
+async def _get_client(data, proxy_dict) -> TelegramClient:
+    if data['sessionType'] == 'tdata':
+        client, api = await tdata_cache.client(account_path(data['pathDirectory'], data['id']), data['id'], proxy_dict)
+        data["type"] = "telethon"
+        data['apiJson'] = proccess_api_json({
+            "api_id": api.api_id,
+            "api_hash": api.api_hash,
+            "device_model": api.device_model,
+            "device": api.device_model,
+            "system_version": api.system_version,
+            "app_version": api.app_version,
+            "system_lang_code": api.system_lang_code,
+            "app_version": api.app_version,
+            "lang_code": api.lang_code,
+            "lang_pack": api.lang_pack,
+            "pid": api.pid
+        })
+    else:
+        check_deadline("client construction")
+        client = TelegramClient(
+            session=session_store.session(
+                data['id'], lambda: account_path(data['pathDirectory'], data['id'], ".session")),
+            api_id=data['apiJson']['api_id'],
+            api_hash=data['apiJson']['api_hash'],
+            device_model=data['apiJson']['device_model'],
+            system_version=data['apiJson']['system_version'],
+            app_version=data['apiJson']['app_version'],
+            lang_code=data['apiJson']['lang_code'],
+            receive_updates=False,
+            proxy=proxy_dict,
+            auto_reconnect=False,
+            connection_retries=0
+        )
 
-async def _get_tonstation(client, data):
-    return await request_app_web_view(client, 'tonstationgames_bot', 'app', data.get("tgIdentification"),
-                                      data.get("referralCode"))
+    watch_self_user(client, str(data['id']))
+    instrument_client(client)
+    return client
 
 
-async def _get_horizon(client, data):
-    return await request_app_web_view(client, 'HorizonLaunch_bot', 'HorizonLaunch', data.get("tgIdentification"),
-                                      data.get("referralCode"))
+class PooledClient:
+    def __init__(self, client, api_json):
+        self.client = client
+        self.api_json = api_json
+        self.last_used = time.monotonic()
+        self.users = 0
+        self.pinned_until = 0.0
+
+
+class ClientPool:
+    def __init__(self, max_size, idle_ttl, health_check_after):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.health_check_after = health_check_after
+        self.entries = OrderedDict()
+        # entries dropped from the pool while still lent out, closed when the last borrower returns
+        self.retired = {}
+        self.locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.health_check_failures = 0
+
+    @staticmethod
+    def key(data):
+        return str(data['id']), data['proxy']
+
+    async def acquire(self, data, proxy_dict) -> TelegramClient:
+        key = self.key(data)
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                # borrowed during the ping so the sweeper does not close it underneath
+                entry.users += 1
+                try:
+                    healthy = entry.users > 1 or await self._is_healthy(entry)
+                finally:
+                    entry.users -= 1
+                if healthy:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    self._lend(entry, data)
+                    return entry.client, False
+                self.health_check_failures += 1
+                if self.entries.get(key) is entry:
+                    self.entries.pop(key)
+                await self._close(entry.client)
+
+            self.misses += 1
+            # one auth key must not stay connected through two proxies
+            await self._drop_other_proxies(key)
+            client = await within_deadline(self._connect(data, proxy_dict), "connect", DEADLINE_CONNECT_BUDGET)
+            entry = PooledClient(client, data['apiJson'] if data['sessionType'] == 'tdata' else None)
+            self.entries[key] = entry
+            self._lend(entry, data)
+            await self._evict_overflow()
+            return client, True
+
+    async def release(self, data, client, success):
+        key = self.key(data)
+        entry = self.entries.get(key)
+        if entry is None or entry.client is not client:
+            entry = self.retired.get(client)
+            if entry is None:
+                await self._close(client)
+                return
+            entry.users -= 1
+            if entry.users == 0:
+                self.retired.pop(client)
+                await self._close(client)
+            return
+        entry.users -= 1
+        entry.last_used = time.monotonic()
+        if not success or not client.is_connected():
+            self.entries.pop(key)
+            if entry.users == 0:
+                await self._close(client)
+            else:
+                self.retired[client] = entry
+
+    def pin(self, data, until):
+        entry = self.entries.get(self.key(data))
+        if entry is not None:
+            entry.pinned_until = max(entry.pinned_until, until)
+
+    async def sweep(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self.entries.items()
+                   if not entry.users and entry.pinned_until <= now and now - entry.last_used > self.idle_ttl]
+        for key in expired:
+            entry = self.entries.pop(key)
+            self.evictions += 1
+            await self._close(entry.client)
+        # pinned clients are pinged while idle so they are still connected when the request comes
+        stale = [(key, entry) for key, entry in self.entries.items()
+                 if not entry.users and entry.pinned_until > now and now - entry.last_used >= self.health_check_after]
+        await asyncio.gather(*[self._keep_alive(key, entry) for key, entry in stale])
+        for key in [key for key, lock in self.locks.items() if key not in self.entries and not lock_in_use(lock)]:
+            self.locks.pop(key)
+
+    async def run_sweeper(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Client pool sweep failed: {e}")
+
+    async def close(self):
+        entries = list(self.entries.values()) + list(self.retired.values())
+        self.entries.clear()
+        self.retired.clear()
+        self.locks.clear()
+        for entry in entries:
+            await self._close(entry.client)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "size": len(self.entries),
+            "inUse": sum(1 for entry in self.entries.values() if entry.users),
+            "retired": len(self.retired),
+            "pinned": sum(1 for entry in self.entries.values() if entry.pinned_until > now),
+            "maxSize": self.max_size,
+            "idleTtl": self.idle_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "healthCheckFailures": self.health_check_failures,
+        }
+
+    def _lend(self, entry, data):
+        entry.users += 1
+        entry.last_used = time.monotonic()
+        if entry.api_json is not None:
+            data["type"] = "telethon"
+            data['apiJson'] = entry.api_json
+
+    async def _connect(self, data, proxy_dict):
+        with observe_phase("get_client"):
+            client = await _get_client(data, proxy_dict)
+        try:
+            if not client.is_connected():
+                with observe_phase("connect"):
+                    await client.connect()
+        except BaseException:
+            await self._close(client)
+            raise
+        return client
+
+    async def _is_healthy(self, entry):
+        if not entry.client.is_connected():
+            return False
+        if time.monotonic() - entry.last_used < self.health_check_after:
+            return True
+        try:
+            await within_deadline(entry.client(functions.PingRequest(ping_id=random.getrandbits(63))),
+                                  "health check", timeout=5)
+            return True
+        except DeadlineExceededError:
+            raise
+        except Exception:
+            return False
+
+    async def _keep_alive(self, key, entry):
+        entry.users += 1
+        try:
+            healthy = await self._is_healthy(entry)
+        finally:
+            entry.users -= 1
+        if healthy:
+            entry.last_used = time.monotonic()
+        elif self.entries.get(key) is entry and not entry.users:
+            self.health_check_failures += 1
+            self.entries.pop(key)
+            await self._close(entry.client)
+
+    async def _drop_other_proxies(self, key):
+        stale = [other for other, entry in self.entries.items()
+                 if other[0] == key[0] and other != key and not entry.users]
+        for other in stale:
+            entry = self.entries.pop(other)
+            self.evictions += 1
+            await self._close(entry.client)
+
+    async def _evict_overflow(self):
+        while len(self.entries) > self.max_size:
+            now = time.monotonic()
+            idle = [key for key, entry in self.entries.items() if not entry.users]
+            key = next((key for key in idle if self.entries[key].pinned_until <= now), idle[0] if idle else None)
+            if key is None:
+                return
+            entry = self.entries.pop(key)
+            self.evictions += 1
+            await self._close(entry.client)
 
+    @staticmethod
+    async def _close(client):
+        try:
+            with trace_span("disconnect"):
+                await client.disconnect()
+        except:
+            pass
 
-async def _get_busers(client, data):
-    return await request_app_web_view(client, 'b_usersbot', 'join', data.get("tgIdentification"),
-                                      data.get("referralCode"))
 
+def lock_in_use(lock):
+    return lock is not None and (lock.locked() or bool(getattr(lock, '_waiters', None)))
 
-async def _get_catsdogs(client, data):
-    return await request_app_web_view(client, 'catsdogs_game_bot', 'join', data.get("tgIdentification"),
-                                      data.get("referralCode"))
 
+client_pool = ClientPool(CLIENT_POOL_MAX_SIZE, CLIENT_POOL_IDLE_TTL, CLIENT_POOL_HEALTH_CHECK_AFTER)
 
-async def _get_notpixel(client, data):
-    return await request_app_web_view(client, 'notpixel', 'app', data.get("tgIdentification"),
-                                      data.get("referralCode"))
 
+class SessionFlight:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.calls = {}
 
-async def _get_notgames(client, data):
-    return await request_app_web_view(client, 'notgames_bot', 'squads', data.get("tgIdentification"),
-                                      data.get("referralCode"))
 
+class SessionFlights:
+    def __init__(self):
+        self.sessions = {}
+        self.executions = 0
+        self.shared = 0
 
-async def _get_paws(client, data):
-    return await request_app_web_view(client, 'Never_Back_Down_PWS_Bot', 'login', data.get("tgIdentification"),
-                                      "eyJyZWRpcmVjdFRvIjoiaHR0cHM6Ly9wYXdzLmNvbW11bml0eSJ9")
+    async def run(self, session_id, call_key, factory):
+        flight = self.sessions.get(session_id)
+        if flight is None:
+            flight = self.sessions[session_id] = SessionFlight()
+        task = flight.calls.get(call_key)
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(self._execute(session_id, flight, call_key, factory))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            flight.calls[call_key] = task
+        else:
+            self.shared += 1
+        # a caller that goes away must not cancel the call for the others
+        return await asyncio.shield(task)
 
+    async def _execute(self, session_id, flight, call_key, factory):
+        try:
+            async with flight.lock:
+                return await factory()
+        finally:
+            flight.calls.pop(call_key, None)
+            if not flight.calls and self.sessions.get(session_id) is flight:
+                self.sessions.pop(session_id)
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "calls": sum(len(flight.calls) for flight in self.sessions.values()),
+            "executions": self.executions,
+            "shared": self.shared,
+        }
+
+
+session_flights = SessionFlights()
+
+
+class ProxyBreaker:
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.results = deque()
+        self.failures = 0
+        self.opened_at = 0.0
+        self.open_time = PROXY_BREAKER_OPEN_TIME
+        self.probing = False
+        self.opens = 0
+        self.rejected = 0
+
+    def allow(self):
+        # returns True for the caller that gets to probe a half-open proxy
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.open_time:
+            self.state = self.HALF_OPEN
+        if self.state == self.CLOSED:
+            return False
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        raise ProxyError("Proxy circuit is open")
+
+    def record(self, success):
+        now = time.monotonic()
+        if self.state != self.CLOSED:
+            self.probing = False
+            if success:
+                self.state = self.CLOSED
+                self.results.clear()
+                self.failures = 0
+                self.open_time = PROXY_BREAKER_OPEN_TIME
+            elif self.state == self.HALF_OPEN:
+                # still dead, wait longer before the next probe
+                self.open_time = min(self.open_time * 2, PROXY_BREAKER_MAX_OPEN_TIME)
+                self._open(now)
+            return
+        self.results.append((now, success))
+        self.failures += not success
+        while self.results and now - self.results[0][0] > PROXY_BREAKER_WINDOW:
+            self.failures -= not self.results.popleft()[1]
+        if (self.failures >= PROXY_BREAKER_MIN_FAILURES
+                and self.failures >= len(self.results) * PROXY_BREAKER_FAILURE_RATIO):
+            self._open(now)
+
+    def _open(self, now):
+        if self.state == self.CLOSED:
+            self.opens += 1
+        self.state = self.OPEN
+        self.opened_at = now
+
+    def stats(self):
+        return {"state": self.state, "opens": self.opens, "rejected": self.rejected}
+
+
+def is_proxy_failure(e):
+    # DeadlineExceededError is not counted, running out of budget says nothing about the proxy
+    return isinstance(e, (OSError, python_socks.ProxyError))
+
+
+class ProxyQueue:
+    def __init__(self, max_in_flight):
+        self.breaker = ProxyBreaker()
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.queued = 0
+        self.acquired = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def stats(self):
+        return {
+            "inFlight": self.in_flight,
+            "queued": self.queued,
+            "acquired": self.acquired,
+            "rejected": self.rejected,
+            "queueTimeouts": self.timeouts,
+            "waitAvg": self.wait_total / self.acquired if self.acquired else 0.0,
+            "waitMax": self.wait_max,
+            "breaker": self.breaker.stats(),
+        }
+
+
+class ProxyScheduler:
+    def __init__(self, max_in_flight, max_queue, queue_timeout):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.queues = {}
+
+    @staticmethod
+    def key(proxy_dict):
+        return f"{proxy_dict['addr']}:{proxy_dict['port']}"
+
+    @asynccontextmanager
+    async def slot(self, proxy_dict):
+        key = self.key(proxy_dict)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = ProxyQueue(self.max_in_flight)
+        probe = queue.breaker.allow()
+        try:
+            async with self._acquire(key, queue):
+                yield queue.breaker
+        finally:
+            if probe and queue.breaker.probing:
+                # the probe ended before it reached the proxy, let the next caller try
+                queue.breaker.probing = False
+
+    @asynccontextmanager
+    async def _acquire(self, key, queue):
+        if queue.queued >= self.max_queue:
+            queue.rejected += 1
+            raise ProxyError("Proxy queue is full")
+
+        check_deadline("proxy slot")
+        queue.queued += 1
+        started = time.monotonic()
+        try:
+            await within_deadline(queue.semaphore.acquire(), "proxy slot", timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            queue.timeouts += 1
+            raise ProxyError("Proxy queue wait timed out")
+        finally:
+            queue.queued -= 1
+        waited = time.monotonic() - started
+        PROXY_QUEUE_WAIT.observe(waited, proxy=key)
+        queue.acquired += 1
+        queue.wait_total += waited
+        queue.wait_max = max(queue.wait_max, waited)
+
+        queue.in_flight += 1
+        try:
+            yield
+        finally:
+            queue.in_flight -= 1
+            queue.semaphore.release()
 
-async def _get_community(client, data):
-    return await request_app_web_view(client, 'community_bot', 'join', data.get("tgIdentification"),
-                                      data.get("referralCode"))
+    def stats(self):
+        return {key: queue.stats() for key, queue in self.queues.items()}
 
 
-async def _get_tverse(client, data):
-    return await request_web_view(client, 'tverse', 'tverse', "https://app.tonverse.app/", data.get("tgIdentification"),
-                                  None)
+proxy_scheduler = ProxyScheduler(PROXY_MAX_IN_FLIGHT, PROXY_MAX_QUEUE, PROXY_QUEUE_TIMEOUT)
 
 
-async def _get_midas(client, data):
-    return await request_app_web_view(client, 'MidasRWA_bot', 'app', data.get("tgIdentification"),
-                                      data.get("referralCode"))
+async def run_with_client(session_request: SessionRequest, handler):
+    data, proxy_dict = session_request.data, session_request.proxy_dict
+    if handler is _get_tg_web_app_data:
+        # a fresh webview answer is a lookup, no client and no proxy slot
+        response = webview_cache.get(data)
+        if response is not None:
+            return response
+    call_key = (handler, session_request.raw)
+    # a shared call keeps the deadline of whoever started it, every caller still stops at its own
+    token = request_deadline.set(session_request.deadline)
+    try:
+        response = await within_deadline(session_flights.run(session_request.session_id, call_key,
+                                                             lambda: _run_with_client(data, proxy_dict, handler)),
+                                         operation_name(handler))
+    finally:
+        request_deadline.reset(token)
+    return caller_response(response)
 
 
-async def _get_hipin(client, data):
-    return await request_app_web_view(client, 'hi_PIN_bot', 'app', data.get("tgIdentification"),
-                                      data.get("referralCode"))
+def caller_response(response):
+    # a shared call returns one response object to every caller, each one sets its own headers on it
+    if not isinstance(response, Response):
+        return response
+    copy = Response(response.body, status_code=response.status_code)
+    copy.raw_headers = list(response.raw_headers)
+    return copy
 
 
-async def _get_coub(client, data):
-    return await request_app_web_view(client, 'coub', 'app', data.get("tgIdentification"),
-                                      data.get("referralCode"))
+async def _run_with_client(data, proxy_dict, handler):
+    started = time.perf_counter()
+    outcome = "success"
+    try:
+        return await _run_in_proxy_slot(data, proxy_dict, handler)
+    except BaseException as e:
+        outcome = classify_exception(e)[0] if isinstance(e, Exception) else "cancelled"
+        raise
+    finally:
+        OPERATION_DURATION.observe(time.perf_counter() - started, operation=operation_name(handler),
+                                   service=data.get("service") or "", outcome=outcome)
 
 
-service_map = {
-    "blum": _get_blum,
-    "iceberg": _get_iceberg,
-    "tapswap": _get_tapswap,
-    "banana": _get_banana,
-    "clayton": _get_clayton,
-    "cats": _get_cats,
-    "major": _get_major,
-    "tonstation": _get_tonstation,
-    "horizon": _get_horizon,
-    "busers": _get_busers,
-    "catsdogs": _get_catsdogs,
-    "notpixel": _get_notpixel,
-    "notgames": _get_notgames,
-    "paws": _get_paws,
-    "community": _get_community,
-    "tverse": _get_tverse,
-    "midas": _get_midas,
-    "hipin": _get_hipin,
-    "coub": _get_coub
-}
+async def _run_in_proxy_slot(data, proxy_dict, handler):
+    async with proxy_scheduler.slot(proxy_dict) as breaker:
+        try:
+            client, connected = await client_pool.acquire(data, proxy_dict)
+        except Exception as e:
+            if is_proxy_failure(e):
+                breaker.record(False)
+            raise
+        if connected:
+            # a pooled client says nothing about whether new connections through the proxy work
+            breaker.record(True)
+        success = False
+        try:
+            response = await within_deadline(handler(client, data), operation_name(handler))
+            success = True
+            return response
+        except Exception as e:
+            if is_proxy_failure(e):
+                breaker.record(False)
+            raise
+        finally:
+            await client_pool.release(data, client, success)
 
 
-async def _get_tg_web_app_data(client, data):
-    # await client.start(phone='0')
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    if data["isUpload"] or data["otherInfo"]:
+async def set_username_if_not_exists(client, me=None):
+    if me is None:
         me = await client.get_me()
-    else:
-        me = User(0)
-    if data["isUpload"]:
-        if data["sessionType"] == "telethon":
-            tdata = await client.ToTDesktop(flag=UseCurrentSession)
-            tdata.SaveTData(os.path.join(data['pathDirectory'], data["id"]))
-        await set_username_if_not_exists(client, me)
+    if me.username is not None:
+        return me
+    candidates = [username for username in generate_usernames(me.first_name, me.last_name)
+                  if not account_store.is_username_taken(username)]
 
-    service_func = service_map.get(data["service"])
-    if service_func:
-        tg_web_app_data, auth_url = await service_func(client, data)
-    else:
-        raise UnknownError(400, f"Service '{data['service']}' not found in service map")
+    async def check(username):
+        try:
+            available = await client(functions.account.CheckUsernameRequest(username))
+        except (UsernameInvalidError, UsernameOccupiedError, UsernamePurchaseAvailableError) as e:
+            # only this candidate is unusable, anything else is about the account and goes up
+            account_store.save_username_taken(username)
+            return e
+        if not available:
+            account_store.save_username_taken(username)
+        return available
+
+    error = Exception("Username not set")
+    for start in range(0, len(candidates), USERNAME_CHECK_CONCURRENCY):
+        wave = candidates[start:start + USERNAME_CHECK_CONCURRENCY]
+        checks = await asyncio.gather(*[check(username) for username in wave])
+        for username, available in zip(wave, checks):
+            if isinstance(available, Exception):
+                error = available
+                continue
+            if not available:
+                continue
+            try:
+                # the updated self user comes back with the reply, no need for get_me()
+                user = await client(functions.account.UpdateUsernameRequest(username))
+            except UsernameOccupiedError as e:
+                account_store.save_username_taken(username)
+                error = e
+                continue
+            if user.username is None:
+                raise Exception("Username not set")
+            return user
+    raise error
+
+
+class ServiceSpec:
+    KINDS = ("webView", "appWebView")
+    REFERRALS = ("startParam", "botStart", "none")
+
+    def __init__(self, name, kind, bot, url=None, short_name=None, referral="startParam", referral_prefix="",
+                 start_param=None, max_concurrency=None, requests_per_minute=None, cache_ttl=None):
+        self.name = name
+        self.kind = kind
+        self.bot = bot
+        self.url = url
+        self.short_name = short_name
+        self.referral = referral
+        self.referral_prefix = referral_prefix
+        self.start_param = start_param
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.cache_ttl = cache_ttl
+
+    @classmethod
+    def from_config(cls, name, entry) -> "ServiceSpec":
+        if not isinstance(entry, dict) or not entry.get("bot"):
+            raise ValueError(f"Service '{name}' needs a bot")
+        service = cls(name, entry.get("kind"), entry["bot"], entry.get("url"), entry.get("shortName"),
+                      entry.get("referral", "startParam"), entry.get("referralPrefix", ""), entry.get("startParam"),
+                      entry.get("maxConcurrency"), entry.get("requestsPerMinute"), entry.get("cacheTtl"))
+        if service.kind not in cls.KINDS:
+            raise ValueError(f"Service '{name}' has unknown kind {service.kind!r}")
+        if service.kind == "webView" and not service.url:
+            raise ValueError(f"Service '{name}' needs a url")
+        if service.kind == "appWebView" and not service.short_name:
+            raise ValueError(f"Service '{name}' needs a shortName")
+        if service.referral not in cls.REFERRALS:
+            raise ValueError(f"Service '{name}' has unknown referral {service.referral!r}")
+        for limit in (service.max_concurrency, service.requests_per_minute, service.cache_ttl):
+            if limit is not None and (not isinstance(limit, (int, float)) or limit <= 0):
+                raise ValueError(f"Service '{name}' limits must be positive numbers")
+        return service
+
+
+class ServiceLimiter:
+    def __init__(self):
+        self.max_concurrency = None
+        self.interval = 0.0
+        self.next_start = 0.0
+        self.in_flight = 0
+        self.waiters = deque()
+        self.requests = 0
+        self.throttled = 0
+
+    def configure(self, max_concurrency, requests_per_minute, workers):
+        # sessions are spread over the workers, so is every service's traffic
+        self.max_concurrency = max(1, -(-max_concurrency // workers)) if max_concurrency else None
+        self.interval = 60 * workers / requests_per_minute if requests_per_minute else 0.0
+        if not self.interval:
+            self.next_start = 0.0
+        self._wake()
+
+    def _full(self):
+        return self.max_concurrency is not None and self.in_flight >= self.max_concurrency
+
+    def _wake(self):
+        while self.waiters and not self._full():
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # the slot is handed over, the waiter does not count itself in
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def _enter(self):
+        if not self.waiters and not self._full():
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, name):
+        with trace_span("service_slot", service=name):
+            await within_deadline(self._enter(), "service slot")
+            try:
+                now = time.monotonic()
+                delay = max(0.0, self.next_start - now)
+                check_deadline("service slot", delay)
+                self.next_start = max(now, self.next_start) + self.interval
+                if delay:
+                    self.throttled += 1
+                    await asyncio.sleep(delay)
+            except BaseException:
+                self._release()
+                raise
+        self.requests += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        return {
+            "inFlight": self.in_flight,
+            "waiting": len(self.waiters),
+            "maxConcurrency": self.max_concurrency,
+            "requestsPerMinute": round(60 / self.interval, 2) if self.interval else None,
+            "requests": self.requests,
+            "throttled": self.throttled,
+        }
+
+
+class ServiceRegistry:
+    def __init__(self, path, reload_interval):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.workers = 1
+        self.services = {}
+        self.limiters = {}
+        self.mtime = None
+        self.checked = None
+        self.loads = 0
+
+    def get(self, name) -> "ServiceSpec | None":
+        # the file is watched, a changed service goes live without a restart
+        if self.checked is None or time.monotonic() - self.checked >= self.reload_interval:
+            self.reload()
+        return self.services.get(name)
+
+    def reload(self):
+        self.checked = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if self.mtime is None:
+                raise
+            logger.error(f"Service registry {self.path} is not readable, keeping the previous one: {e}")
+            return
+        if mtime == self.mtime:
+            return
+        # a broken edit is reported once and waits for the next change of the file
+        self.mtime = mtime
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                config = json.load(file)
+            if not isinstance(config, dict):
+                raise ValueError("expected an object of services")
+            services = {name: ServiceSpec.from_config(name, entry) for name, entry in config.items()}
+        except (OSError, ValueError) as e:
+            if not self.loads:
+                raise
+            logger.error(f"Service registry {self.path} not reloaded, keeping the previous one: {e}")
+            return
+        self.services = services
+        self.loads += 1
+        self.apply_limits()
+        logger.info(f"Loaded {len(services)} services from {self.path}")
+
+    def apply_limits(self):
+        for name, service in self.services.items():
+            self.limiter(name).configure(service.max_concurrency, service.requests_per_minute, self.workers)
+
+    def limiter(self, name) -> ServiceLimiter:
+        limiter = self.limiters.get(name)
+        if limiter is None:
+            limiter = self.limiters[name] = ServiceLimiter()
+        return limiter
+
+    def stats(self):
+        return {name: limiter.stats() for name, limiter in self.limiters.items() if name in self.services}
+
+
+service_registry = ServiceRegistry(SERVICES_PATH, SERVICE_REGISTRY_RELOAD_INTERVAL)
+
+
+async def request_service_web_view(client, data, service: ServiceSpec):
+    referral_code = data.get("referralCode")
+    if service.referral == "botStart":
+        # these bots take the referral from /start, not from the web view
+        await handle_bot_start(client, data['id'], service.bot, referral_code)
+        referral_code = None
+    elif service.referral == "none":
+        referral_code = None
+    if service.start_param is not None:
+        referral_code = service.start_param
+    elif referral_code is not None:
+        referral_code = service.referral_prefix + referral_code
+    if service.kind == "webView":
+        return await request_web_view(client, service.bot, service.bot, service.url, data.get("tgIdentification"),
+                                      referral_code)
+    return await request_app_web_view(client, service.bot, service.short_name, data.get("tgIdentification"),
+                                      referral_code)
+
+
+class WebViewCache:
+    def __init__(self, max_age, max_size):
+        self.max_age = max_age
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(data):
+        return str(data['id']), data['service'], data.get("referralCode"), data.get("tgIdentification")
+
+    @staticmethod
+    def cacheable(data):
+        # an upload writes files and sets a username, it has to reach the account every time
+        return not data.get("isUpload")
+
+    def get(self, data):
+        if not self.cacheable(data):
+            return None
+        key = self.key(data)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= time.time():
+            self.entries.pop(key)
+            entry = None
+        profile = User(0)
+        if entry is not None and data.get("otherInfo"):
+            profile = account_store.get_profile(data['id'])
+        if entry is None or profile is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return web_app_data_response(data, profile, entry[1], entry[2])
+
+    def put(self, data, tg_web_app_data, auth_url):
+        # init data is signed with auth_date, services reject it after their own max age
+        auth_date = re.search(r'(?:^|&)auth_date=(\d+)', tg_web_app_data)
+        if not self.cacheable(data) or auth_date is None:
+            return
+        service = service_registry.get(data['service'])
+        max_age = service.cache_ttl if service is not None and service.cache_ttl is not None else self.max_age
+        expires = int(auth_date.group(1)) + max_age
+        if expires <= time.time():
+            return
+        key = self.key(data)
+        self.entries[key] = (expires, tg_web_app_data, auth_url)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
 
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+webview_cache = WebViewCache(WEBVIEW_CACHE_MAX_AGE, WEBVIEW_CACHE_MAX_SIZE)
+
+
+def web_app_data_response(data, me, tg_web_app_data, auth_url):
     return JSONResponse(
         {
             "status": "success",
@@ -523,431 +2426,776 @@ async def _get_tg_web_app_data(client, data):
         })
 
 
+async def _get_tg_web_app_data(client, data):
+    # await client.start(phone='0')
+    await ensure_authorized(client)
+    if data["isUpload"] or data["otherInfo"]:
+        me = await get_profile(client, data)
+    else:
+        me = User(0)
+    if data["isUpload"]:
+        if data["sessionType"] == "telethon":
+            tdata = await client.ToTDesktop(flag=UseCurrentSession)
+            tdata.SaveTData(account_path(data['pathDirectory'], data["id"], create=True))
+        await set_username_if_not_exists(client, me)
+        me = await get_profile(client, data)
+
+    service = service_registry.get(data["service"])
+    if service is None:
+        raise UnknownError(400, f"Service '{data['service']}' not found in service registry")
+    # a slow bot backend is throttled on its own, other services keep going
+    async with service_registry.limiter(service.name).slot(service.name):
+        with observe_phase("service", service.name):
+            tg_web_app_data, auth_url = await request_service_web_view(client, data, service)
+    webview_cache.put(data, tg_web_app_data, auth_url)
+    return web_app_data_response(data, me, tg_web_app_data, auth_url)
+
+
 @app.post("/api/getTgWebAppData")
 async def get_tg_web_app_data(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_get_tg_web_app_data(client, data), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
+    return await run_with_client(get_session_request(request), _get_tg_web_app_data)
+
+
+class ChannelIndex:
+    def __init__(self):
+        self.channels = {}
+        self.usernames = {}
+        self.loaded = time.monotonic()
+
+    def add(self, entity):
+        self.channels[entity.id] = InputChannel(entity.id, entity.access_hash)
+        for username in [entity.username] + [item.username for item in entity.usernames or []]:
+            if username:
+                self.usernames[username.lower()] = entity.id
+
+    def find(self, reference):
+        if isinstance(reference, int):
+            return reference if reference in self.channels else None
+        return self.usernames.get(reference)
+
+    def contains(self, reference):
+        return self.find(reference) is not None
+
+
+class ChannelIndexes:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.indexes = OrderedDict()
+
+    async def get(self, client, session_id) -> ChannelIndex:
+        session_id = str(session_id)
+        index = self.indexes.get(session_id)
+        if index is None or time.monotonic() - index.loaded > self.ttl:
+            index = await self.load(client)
+            self.indexes[session_id] = index
+            while len(self.indexes) > self.max_size:
+                self.indexes.popitem(last=False)
+        self.indexes.move_to_end(session_id)
+        return index
+
+    @staticmethod
+    async def load(client) -> ChannelIndex:
+        index = ChannelIndex()
+        # iter_dialogs pages through GetDialogsRequest across all folders
+        async for dialog in client.iter_dialogs(ignore_migrated=True):
+            entity = dialog.entity
+            if isinstance(entity, Channel) and not entity.left:
+                index.add(entity)
+        return index
+
+    async def verified(self, client, session_id, references) -> ChannelIndex:
+        # a kick or ban is not in the snapshot, one GetChannelsRequest checks every channel it would answer for
+        index = await self.get(client, session_id)
+        hits = {index.find(reference) for reference in references} - {None}
+        if not hits:
+            return index
+        try:
+            chats = (await client(functions.channels.GetChannelsRequest([index.channels[hit] for hit in hits]))).chats
+            stale = len(chats) < len(hits) or any(not isinstance(chat, Channel) or chat.left for chat in chats)
+        except (UserNotParticipantError, ChannelPrivateError):
+            stale = True
+        if stale:
+            self.invalidate(session_id)
+            index = await self.get(client, session_id)
+        return index
+
+    def invalidate(self, session_id):
+        self.indexes.pop(str(session_id), None)
+
+
+channel_indexes = ChannelIndexes(CHANNEL_INDEX_TTL, CHANNEL_INDEX_MAX_SIZE)
+
+
+def channel_reference(channel):
+    reference = re.sub(r'^(https?://)?(www\.)?(t|telegram)\.me/', '', str(channel).strip())
+    reference = reference.lstrip('@').split('?')[0].split('/')[0]
+    if re.fullmatch(r'-?\d+', reference):
+        return int(reference[4:]) if reference.startswith('-100') else abs(int(reference))
+    if not re.fullmatch(r'[a-zA-Z][\w\d]{3,31}', reference) or reference.lower() == 'joinchat':
+        # invite links and anything else need a real lookup
+        return None
+    return reference.lower()
 
 
 async def _join_channels(client, data):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    me = await client.get_me()
-    for channel in data['channels']:
-        if not channel:
+    await ensure_authorized(client)
+    channels = [channel for channel in dict.fromkeys(data['channels']) if channel]
+    if not channels:
+        return JSONResponse({"status": "success", "channels": []})
+    index = await channel_indexes.verified(client, data['id'], [channel_reference(channel) for channel in channels])
+    semaphore = asyncio.Semaphore(JOIN_RESOLVE_CONCURRENCY)
+
+    async def resolve(channel):
+        if index.contains(channel_reference(channel)):
+            return None
+        async with semaphore:
+            return await client.get_entity(channel)
+
+    resolved = await asyncio.gather(*[resolve(channel) for channel in channels], return_exceptions=True)
+
+    results = []
+    joined = []
+    too_many = None
+    for channel, entity in zip(channels, resolved):
+        if isinstance(entity, Exception):
+            results.append({"channel": channel, "status": "error", "detail": str(entity)})
+            continue
+        if entity is None or index.contains(entity.id):
+            results.append({"channel": channel, "status": "member"})
             continue
+        if too_many is not None:
+            results.append({"channel": channel, "status": "error", "detail": str(too_many)})
+            continue
+        if joined:
+            check_deadline("JoinChannelRequest", JOIN_INTERVAL + DEADLINE_RPC_BUDGET)
+            await asyncio.sleep(JOIN_INTERVAL)
         try:
-            channel = await client.get_entity(channel)
-            await client(GetParticipantRequest(channel, me.id))
-        except:
-            try:
-                await client(functions.channels.JoinChannelRequest(channel))
-                await client(UpdateNotifySettingsRequest(
-                    peer=channel,
-                    settings=DEFAULT_MUTE_SETTINGS
-                ))
-                await client.edit_folder(channel, 1)
-            except Exception as e:
-                pass
-                # if "You have joined too many channels/supergroups" not in str(e):
-                #    raise e
-    return JSONResponse({"status": "success"})
+            await client(functions.channels.JoinChannelRequest(entity))
+            await client(UpdateNotifySettingsRequest(
+                peer=entity,
+                settings=DEFAULT_MUTE_SETTINGS
+            ))
+            joined.append(entity)
+            index.add(entity)
+            results.append({"channel": channel, "status": "joined"})
+        except DeadlineExceededError:
+            raise
+        except Exception as e:
+            if isinstance(e, ChannelsTooMuchError):
+                too_many = e
+            results.append({"channel": channel, "status": "error", "detail": str(e)})
+
+    if joined:
+        # archive every new channel with one request
+        await client(functions.folders.EditPeerFoldersRequest([
+            InputFolderPeer(peer=get_input_peer(entity), folder_id=1) for entity in joined
+        ]))
+    return JSONResponse({"status": "success", "channels": results})
 
 
 @app.post("/api/joinChannels")
 async def join_channels(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
-
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_join_channels(client, data), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
+    return await run_with_client(get_session_request(request), _join_channels)
 
 
 async def _create_tdata(client, data):
     tdata = await client.ToTDesktop(flag=UseCurrentSession)
-    tdata.save(data['pathDirectory'])
+    tdata.SaveTData(account_path(data['pathDirectory'], data["id"], create=True))
     return JSONResponse({"status": "success"})
 
 
 @app.post("/api/createTData")
 async def create_tdata(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
+    return await run_with_client(get_session_request(request), _create_tdata)
 
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_create_tdata(client, data), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
 
+def apply_profile_badges(first_name, last_name, add=(), remove=()):
+    for badge in remove:
+        if first_name:
+            first_name = first_name.replace(badge, "")
+        if last_name:
+            last_name = last_name.replace(badge, "")
+    for badge in add:
+        if (first_name and badge in first_name) or (last_name and badge in last_name):
+            continue
+        if first_name:
+            first_name = first_name + badge
+        else:
+            last_name = (last_name or "") + badge
+    return first_name, last_name
+
+
+async def _update_profile_badges(client, data, add=None, remove=None):
+    await ensure_authorized(client)
+    if add is None:
+        add = data.get("add") or []
+    if remove is None:
+        remove = data.get("remove") or []
+    add = [PROFILE_BADGES.get(badge, badge) for badge in add]
+    remove = [PROFILE_BADGES.get(badge, badge) for badge in remove]
+    me = await get_profile(client, data)
+    first_name, last_name = apply_profile_badges(me.first_name, me.last_name, add, remove)
+    if first_name != me.first_name or last_name != me.last_name:
+        # fields left out of UpdateProfileRequest (about) stay unchanged
+        await client(functions.account.UpdateProfileRequest(first_name=first_name, last_name=last_name))
+    return JSONResponse({"status": "success", "firstName": first_name, "lastName": last_name})
 
-async def _add_diamond(client):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    me = await client.get_me()
-    user = await client(GetFullUserRequest('me'))
-    if (me.first_name and "💎" in me.first_name) or (me.last_name and "💎" in me.last_name):
-        return JSONResponse({"status": "success"})
-    if me.first_name:
-        first_name = me.first_name + "💎"
-        last_name = me.last_name
-    else:
-        first_name = me.first_name
-        last_name = me.last_name + "💎"
-    await client(functions.account.UpdateProfileRequest(first_name=first_name, last_name=last_name,
-                                                        about=user.full_user.about))
+
+@app.post("/api/profileBadges")
+async def profile_badges(request: Request):
+    return await run_with_client(get_session_request(request), _update_profile_badges)
+
+
+async def _add_diamond(client, data):
+    return await _update_profile_badges(client, data, add=["diamond"])
 
 
 @app.post("/api/addDiamond")
 async def add_diamond(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
-
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_add_diamond(client), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
+    return await run_with_client(get_session_request(request), _add_diamond)
 
 
-async def _remove_diamond(client):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    me = await client.get_me()
-    user = await client(GetFullUserRequest('me'))
-    if (me.first_name and "💎" not in me.first_name) or (me.last_name and "💎" not in me.last_name):
-        return JSONResponse({"status": "success"})
-    if me.first_name:
-        first_name = me.first_name.replace("💎", "")
-        last_name = me.last_name
-    else:
-        first_name = me.first_name
-        last_name = me.last_name.replace("💎", "")
-    await client(functions.account.UpdateProfileRequest(first_name=first_name, last_name=last_name,
-                                                        about=user.full_user.about))
+async def _remove_diamond(client, data):
+    return await _update_profile_badges(client, data, remove=["diamond"])
 
 
 @app.post("/api/removeDiamond")
 async def remove_diamond(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
-
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_remove_diamond(client), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
+    return await run_with_client(get_session_request(request), _remove_diamond)
 
 
-async def _add_cat(client):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    me = await client.get_me()
-    user = await client(GetFullUserRequest('me'))
-    if (me.first_name and "🐈‍⬛" in me.first_name) or (me.last_name and "🐈‍⬛" in me.last_name):
-        return JSONResponse({"status": "success"})
-    if me.first_name:
-        first_name = me.first_name + "🐈‍⬛"
-        last_name = me.last_name
-    else:
-        first_name = me.first_name
-        last_name = me.last_name + "🐈‍⬛"
-    await client(functions.account.UpdateProfileRequest(first_name=first_name, last_name=last_name,
-                                                        about=user.full_user.about))
+async def _add_cat(client, data):
+    return await _update_profile_badges(client, data, add=["cat"])
 
 
 @app.post("/api/addCat")
 async def add_cat(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
+    return await run_with_client(get_session_request(request), _add_cat)
 
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_add_cat(client), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
 
-
-async def _remove_cat(client):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    me = await client.get_me()
-    user = await client(GetFullUserRequest('me'))
-    if (me.first_name and "🐈‍⬛" not in me.first_name) or (me.last_name and "🐈‍⬛" not in me.last_name):
-        return JSONResponse({"status": "success"})
-    if me.first_name:
-        first_name = me.first_name.replace("🐈‍⬛", "")
-        last_name = me.last_name
-    else:
-        first_name = me.first_name
-        last_name = me.last_name.replace("🐈‍⬛", "")
-    await client(functions.account.UpdateProfileRequest(first_name=first_name, last_name=last_name,
-                                                        about=user.full_user.about))
+async def _remove_cat(client, data):
+    return await _update_profile_badges(client, data, remove=["cat"])
 
 
 @app.post("/api/removeCat")
 async def remove_cat(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
+    return await run_with_client(get_session_request(request), _remove_cat)
 
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_remove_cat(client), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
 
+async def _add_pixel(client, data):
+    return await _update_profile_badges(client, data, add=["pixel"])
 
-async def _start_bot(client, data):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    await handle_bot_start(client, data.get("bot"), data.get("referralCode"))
 
+@app.post("/api/addPixel")
+async def add_pixel(request: Request):
+    return await run_with_client(get_session_request(request), _add_pixel)
 
-@app.post("/api/startBot")
-async def start_bot(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
 
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_start_bot(client, data), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
+async def _remove_pixel(client, data):
+    return await _update_profile_badges(client, data, remove=["pixel"])
 
 
-async def _add_pixel(client):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    me = await client.get_me()
-    user = await client(GetFullUserRequest('me'))
-    if (me.first_name and "▪️" in me.first_name) or (me.last_name and "▪️" in me.last_name):
-        return JSONResponse({"status": "success"})
-    if me.first_name:
-        first_name = me.first_name + "▪️"
-        last_name = me.last_name
-    else:
-        first_name = me.first_name
-        last_name = me.last_name + "▪️"
-    await client(functions.account.UpdateProfileRequest(first_name=first_name, last_name=last_name,
-                                                        about=user.full_user.about))
+@app.post("/api/removePixel")
+async def remove_pixel(request: Request):
+    return await run_with_client(get_session_request(request), _remove_pixel)
 
 
-@app.post("/api/addPixel")
-async def add_pixel(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
+async def _add_paws(client, data):
+    return await _update_profile_badges(client, data, add=["paws"])
 
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_add_pixel(client), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
 
+@app.post("/api/addPaws")
+async def add_paws(request: Request):
+    return await run_with_client(get_session_request(request), _add_paws)
 
-async def _remove_pixel(client):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    me = await client.get_me()
-    user = await client(GetFullUserRequest('me'))
-    if (me.first_name and "▪️" not in me.first_name) or (me.last_name and "▪️" not in me.last_name):
-        return JSONResponse({"status": "success"})
-    if me.first_name:
-        first_name = me.first_name.replace("▪️", "")
-        last_name = me.last_name
-    else:
-        first_name = me.first_name
-        last_name = me.last_name.replace("▪️", "")
-    await client(functions.account.UpdateProfileRequest(first_name=first_name, last_name=last_name,
-                                                        about=user.full_user.about))
 
+async def _remove_paws(client, data):
+    return await _update_profile_badges(client, data, remove=["paws"])
 
-@app.post("/api/removePixel")
-async def remove_pixel(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
 
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_remove_pixel(client), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
+@app.post("/api/removePaws")
+async def remove_paws(request: Request):
+    return await run_with_client(get_session_request(request), _remove_paws)
 
 
-async def _add_paws(client):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    me = await client.get_me()
-    user = await client(GetFullUserRequest('me'))
-    if (me.first_name and "🐾" in me.first_name) or (me.last_name and "🐾" in me.last_name):
-        return JSONResponse({"status": "success"})
-    if me.first_name:
-        first_name = me.first_name + "🐾"
-        last_name = me.last_name
-    else:
-        first_name = me.first_name
-        last_name = me.last_name + "🐾"
-    await client(functions.account.UpdateProfileRequest(first_name=first_name, last_name=last_name,
-                                                        about=user.full_user.about))
+async def _start_bot(client, data):
+    await ensure_authorized(client)
+    await handle_bot_start(client, data['id'], data.get("bot"), data.get("referralCode"))
 
 
-@app.post("/api/addPaws")
-async def add_paws(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
+@app.post("/api/startBot")
+async def start_bot(request: Request):
+    return await run_with_client(get_session_request(request), _start_bot)
+
+
+operation_map = {
+    "getTgWebAppData": _get_tg_web_app_data,
+    "joinChannels": _join_channels,
+    "createTData": _create_tdata,
+    "addDiamond": _add_diamond,
+    "removeDiamond": _remove_diamond,
+    "addCat": _add_cat,
+    "removeCat": _remove_cat,
+    "startBot": _start_bot,
+    "addPixel": _add_pixel,
+    "removePixel": _remove_pixel,
+    "addPaws": _add_paws,
+    "removePaws": _remove_paws,
+    "profileBadges": _update_profile_badges
+}
 
-    client = None
-    try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_add_paws(client), timeout=20)
-    except Exception as e:
-        raise e
-    finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
 
+async def _run_batch_item(handler, item, timeout):
+    raw = json_dumps(item)
+    trace_id = None
+    try:
+        # items outlive the streaming response, so each one is traced on its own
+        with tracer.trace("batch_item", current_trace_id(), id=item.get("id")) as root:
+            trace_id = root.attributes["traceId"]
+            response = await run_with_client(SessionRequest.from_data(item, raw, timeout), handler)
+    except (Exception, OpenTeleException) as e:
+        response = exception_response(e, raw.decode('utf-8'), trace_id)
+    if response is None:
+        return {"status": "success"}
+    return json_loads(response.body)
 
-async def _remove_paws(client):
-    if not client.is_connected():
-        await client.connect()
-    if not await client.is_user_authorized():
-        raise SessionInvalidError()
-    me = await client.get_me()
-    user = await client(GetFullUserRequest('me'))
-    if (me.first_name and "🐾" not in me.first_name) or (me.last_name and "🐾" not in me.last_name):
-        return JSONResponse({"status": "success"})
-    if me.first_name:
-        first_name = me.first_name.replace("🐾", "")
-        last_name = me.last_name
-    else:
-        first_name = me.first_name
-        last_name = me.last_name.replace("🐾", "")
-    await client(functions.account.UpdateProfileRequest(first_name=first_name, last_name=last_name,
-                                                        about=user.full_user.about))
 
+async def _stream_batch(handler, items, concurrency, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
 
-@app.post("/api/removePaws")
-async def remove_paws(request: Request):
-    data = await request.json()
-    data, proxy_dict = process_data_and_proxy(data)
+    async def run_item(index, item):
+        async with semaphore:
+            return index, item, await _run_batch_item(handler, item, timeout)
 
-    client = None
+    tasks = [asyncio.create_task(run_item(index, item)) for index, item in enumerate(items)]
     try:
-        client = await asyncio.wait_for(_get_client(data, proxy_dict), timeout=20)
-        return await asyncio.wait_for(_remove_paws(client), timeout=20)
-    except Exception as e:
-        raise e
+        for task in asyncio.as_completed(tasks):
+            index, item, content = await task
+            yield json_dumps({"index": index, "id": item.get("id"), **content}) + b"\n"
     finally:
-        if client:
-            try:
-                await client.disconnect()
-            except:
-                pass
+        for task in tasks:
+            task.cancel()
+
+
+@app.post("/api/batch")
+async def batch(request: Request):
+    data = json_loads(request.state.body)
+    handler = operation_map.get(data.get("operation"))
+    if handler is None:
+        raise UnknownError(400, f"Operation '{data.get('operation')}' not found in operation map")
+    concurrency = min(int(data.get("concurrency") or BATCH_DEFAULT_CONCURRENCY), BATCH_MAX_CONCURRENCY)
+    # the timeout is a budget for every item, counted from when the item starts
+    timeout = data.get("timeout", request.headers.get("x-request-timeout"))
+    return StreamingResponse(_stream_batch(handler, data["items"], max(concurrency, 1), timeout),
+                             media_type="application/x-ndjson")
+
+
+class Prewarmer:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.tasks = set()
+        self.sessions = 0
+        self.outcomes = {}
+
+    def start(self, items, until, concurrency):
+        task = asyncio.create_task(self._run(items, until, concurrency))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self):
+        return {"running": len(self.tasks), "sessions": self.sessions, **self.outcomes}
+
+    async def _run(self, items, until, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def warm(item):
+            async with semaphore:
+                await self._warm(item, until)
+
+        await asyncio.gather(*[warm(item) for item in items])
+
+    async def _warm(self, item, until):
+        async def prewarm(client, data):
+            await ensure_authorized(client)
+            client_pool.pin(data, until)
+
+        self.sessions += 1
+        try:
+            with tracer.trace("prewarm", id=item.get("id")):
+                await run_with_client(SessionRequest.from_data(item), prewarm)
+            status = "success"
+        except (Exception, OpenTeleException) as e:
+            status = classify_exception(e)[0]
+        self.outcomes[status] = self.outcomes.get(status, 0) + 1
+
+
+prewarmer = Prewarmer(PREWARM_CONCURRENCY)
+
+
+def prewarm_until(data):
+    # warmUntil is a unix timestamp, warmFor a number of seconds from now
+    if data.get("warmUntil") is not None:
+        ttl = float(data["warmUntil"]) - time.time()
+    else:
+        ttl = float(data.get("warmFor") or PREWARM_DEFAULT_TTL)
+    return time.monotonic() + min(max(ttl, 0), PREWARM_MAX_TTL)
+
+
+@app.post("/api/prewarm")
+async def prewarm(request: Request):
+    data = json_loads(request.state.body)
+    concurrency = min(int(data.get("concurrency") or prewarmer.concurrency), BATCH_MAX_CONCURRENCY)
+    prewarmer.start(data["items"], prewarm_until(data), max(concurrency, 1))
+    return JSONResponse({"status": "success", "sessions": len(data["items"])})
+
+
+class JobQueue:
+    def __init__(self, path, workers, max_attempts, result_ttl):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.result_ttl = result_ttl
+        self.tasks = []
+        self.wakeup = None
+        self.finished = {}
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                             "id TEXT PRIMARY KEY, operation TEXT, payload BLOB, status TEXT, "
+                             "status_code INTEGER, result BLOB, attempts INTEGER DEFAULT 0, "
+                             "created REAL, started REAL, finished REAL, session_id TEXT, shard INTEGER DEFAULT 0)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        return self._db
+
+    async def start(self):
+        self.wakeup = asyncio.Semaphore(0)
+        # whatever was running when the process died goes back to the queue
+        self.db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running' AND shard = ?", (worker_index,))
+        if worker_index == 0:
+            self._reshard()
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self._maintain()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, operation, payload: dict) -> str:
+        job_id = uuid.uuid4().hex
+        session_id = str(payload.get("id"))
+        self.db.execute("INSERT INTO jobs (id, operation, payload, status, created, session_id, shard) "
+                        "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                        (job_id, operation, json_dumps(payload), time.time(), session_id, session_shard(session_id)))
+        self._notify()
+        return job_id
+
+    def get(self, job_id):
+        row = self.db.execute("SELECT status, status_code, result, created, started, finished "
+                              "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        status, status_code, result, created, started, finished = row
+        return {
+            "jobId": job_id,
+            "jobStatus": status,
+            "statusCode": status_code,
+            "result": json_loads(result) if result is not None else None,
+            "created": created,
+            "started": started,
+            "finished": finished
+        }
+
+    async def wait(self, job_id, timeout):
+        deadline = time.monotonic() + timeout
+        row = self.db.execute("SELECT shard FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        # only the process that runs the job sets its event, the others just poll
+        event = asyncio.Event() if row is not None and row[0] == worker_index else None
+        if event is not None:
+            self.finished.setdefault(job_id, set()).add(event)
+        try:
+            while True:
+                job = self.get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["jobStatus"] in ("done", "error", "failed") or remaining <= 0:
+                    return job
+                if event is None:
+                    await asyncio.sleep(min(remaining, 1))
+                    continue
+                try:
+                    # a resharded job finishes in another process, that is only seen by polling
+                    await asyncio.wait_for(event.wait(), timeout=min(remaining, 1))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if event is not None:
+                events = self.finished.get(job_id)
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        self.finished.pop(job_id)
+
+    def stats(self):
+        counts = dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {"workers": self.workers if self.tasks else 0, **counts}
+
+    def _notify(self):
+        # at most one wakeup is pending, a worker that claims a job passes it on
+        if self.wakeup is not None and self.wakeup.locked():
+            self.wakeup.release()
+
+    async def _work(self):
+        while True:
+            await self.wakeup.acquire()
+            while True:
+                job = self._claim()
+                if job is None:
+                    break
+                # more jobs may be queued, let the next idle worker look too
+                self._notify()
+                try:
+                    await self._run(*job)
+                except (Exception, OpenTeleException) as e:
+                    # a broken job must not take the worker down with it
+                    logger.error(f"Job {job[0]} failed: {e}")
+                    try:
+                        self._finish(job[0], "error", 200, json_dumps({"status": "unknown_error", "detail": str(e)}))
+                    except sqlite3.Error:
+                        pass
+
+    async def _maintain(self):
+        cleanup_at = 0
+        while True:
+            # jobs queued by another process or moved here by a reshard are only seen by polling
+            self._notify()
+            if worker_index == 0 and time.monotonic() >= cleanup_at:
+                cleanup_at = time.monotonic() + JOB_CLEANUP_INTERVAL
+                try:
+                    self._cleanup()
+                except sqlite3.Error as e:
+                    logger.error(f"Job cleanup failed: {e}")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    def _claim(self):
+        while True:
+            row = self.db.execute("SELECT id, operation, payload, attempts FROM jobs "
+                                  "WHERE status = 'queued' AND shard = ? ORDER BY created LIMIT 1",
+                                  (worker_index,)).fetchone()
+            if row is None:
+                return None
+            job_id, operation, payload, attempts = row
+            if attempts >= self.max_attempts:
+                self._finish(job_id, "failed", 200, json_dumps(
+                    {"status": "unknown_error", "detail": "Job was interrupted too many times"}))
+                continue
+            claimed = self.db.execute("UPDATE jobs SET status = 'running', started = ?, attempts = attempts + 1 "
+                                      "WHERE id = ? AND status = 'queued'", (time.time(), job_id)).rowcount
+            if claimed:
+                return job_id, operation, payload
+
+    async def _run(self, job_id, operation, payload):
+        trace_id = None
+        status = "done"
+        try:
+            handler = operation_map.get(operation)
+            if handler is None:
+                raise UnknownError(400, f"Operation '{operation}' not found in operation map")
+            with tracer.trace("job", jobId=job_id, operation=operation) as root:
+                trace_id = root.attributes["traceId"]
+                response = await run_with_client(SessionRequest.parse(payload), handler)
+        except (Exception, OpenTeleException) as e:
+            status = "done" if classify_exception(e)[0] == "success" else "error"
+            response = exception_response(e, payload.decode('utf-8'), trace_id)
+        if response is None:
+            self._finish(job_id, status, 200, json_dumps({"status": "success"}))
+        else:
+            self._finish(job_id, status, response.status_code, bytes(response.body))
+
+    def _finish(self, job_id, status, status_code, result):
+        self.db.execute("UPDATE jobs SET status = ?, status_code = ?, result = ?, finished = ? WHERE id = ?",
+                        (status, status_code, result, time.time(), job_id))
+        for event in self.finished.pop(job_id, ()):
+            event.set()
+
+    def _reshard(self):
+        # the number of workers may have changed since the jobs were queued
+        shards = worker_ring.size if worker_ring is not None else 1
+        self.db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running' AND shard >= ?", (shards,))
+        rows = self.db.execute("SELECT id, session_id, shard FROM jobs WHERE status = 'queued'").fetchall()
+        moved = [(session_shard(session_id), job_id) for job_id, session_id, shard in rows
+                 if session_shard(session_id) != shard]
+        self.db.executemany("UPDATE jobs SET shard = ? WHERE id = ?", moved)
+
+    def _cleanup(self):
+        self.db.execute("DELETE FROM jobs WHERE status IN ('done', 'error', 'failed') AND finished < ?",
+                        (time.time() - self.result_ttl,))
+
+
+job_queue = JobQueue(JOB_STORE_PATH, JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_RESULT_TTL)
+
+
+@app.post("/api/jobs")
+async def submit_job(request: Request):
+    data = json_loads(request.state.body)
+    if data.get("operation") not in operation_map:
+        raise UnknownError(400, f"Operation '{data.get('operation')}' not found in operation map")
+    job_id = job_queue.submit(data["operation"], data["payload"])
+    return JSONResponse({"status": "success", "jobId": job_id})
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    job = await job_queue.wait(job_id, min(max(wait, 0), JOB_MAX_WAIT))
+    if job is None:
+        return JSONResponse({"status": "not_found", "jobId": job_id}, status_code=404)
+    return JSONResponse({"status": "success", **job})
+
+
+@app.get("/api/stats")
+async def stats():
+    return JSONResponse({
+        "pool": client_pool.stats(),
+        "singleFlight": session_flights.stats(),
+        "proxies": proxy_scheduler.stats(),
+        "jobs": job_queue.stats(),
+        "prewarm": prewarmer.stats(),
+        "tdataCache": tdata_cache.stats(),
+        "webviewCache": webview_cache.stats(),
+        "services": service_registry.stats(),
+        "sessions": session_store.stats(),
+        "layoutMigration": layout_migrator.stats()
+    })
+
+
+def operation_name(handler):
+    return next((name for name, func in operation_map.items() if func is handler), handler.__name__)
+
+
+POOL_CLIENTS = metrics.gauge("session_service_pool_clients", "Pooled clients", ("state",))
+TDATA_CACHE = metrics.counter("session_service_tdata_cache_total", "Decoded tdata cache lookups", ("result",))
+WEBVIEW_CACHE = metrics.counter("session_service_webview_cache_total", "Cached webview lookups", ("result",))
+POOL_PINNED = metrics.gauge("session_service_pool_pinned", "Pooled clients kept warm by prewarm", ())
+POOL_EVENTS = metrics.counter("session_service_pool_events_total", "Pool hits, misses and evictions", ("event",))
+PROXY_IN_FLIGHT = metrics.gauge("session_service_proxy_in_flight", "Sessions using a proxy", ("proxy",))
+PROXY_BREAKER_STATE = metrics.gauge(
+    "session_service_proxy_breaker_state", "Proxy circuit breaker state, 0 closed, 1 half-open, 2 open", ("proxy",))
+PROXY_BREAKER_OPENS = metrics.counter(
+    "session_service_proxy_breaker_opens_total", "Times the proxy circuit breaker opened", ("proxy",))
+PROXY_BREAKER_REJECTED = metrics.counter(
+    "session_service_proxy_breaker_rejected_total", "Requests failed fast by an open circuit", ("proxy",))
+SERVICE_IN_FLIGHT = metrics.gauge("session_service_service_in_flight", "Web view requests per service", ("service",))
+SERVICE_WAITING = metrics.gauge("session_service_service_waiting", "Requests waiting for a service slot", ("service",))
+SERVICE_THROTTLED = metrics.counter(
+    "session_service_service_throttled_total", "Requests delayed by a service rate limit", ("service",))
+PROXY_QUEUED = metrics.gauge("session_service_proxy_queued", "Sessions waiting for a proxy slot", ("proxy",))
+JOBS = metrics.gauge("session_service_jobs", "Jobs by state", ("state",))
+
+
+@metrics.collector
+def collect_state():
+    pool = client_pool.stats()
+    POOL_CLIENTS.set(pool["size"] - pool["inUse"], state="idle")
+    POOL_CLIENTS.set(pool["inUse"], state="in_use")
+    POOL_PINNED.set(pool["pinned"])
+    TDATA_CACHE.set(tdata_cache.hits, result="hit")
+    TDATA_CACHE.set(tdata_cache.misses, result="miss")
+    WEBVIEW_CACHE.set(webview_cache.hits, result="hit")
+    WEBVIEW_CACHE.set(webview_cache.misses, result="miss")
+    for event in ("hits", "misses", "evictions", "healthCheckFailures"):
+        POOL_EVENTS.set(pool[event], event=event)
+    for proxy, queue in proxy_scheduler.queues.items():
+        PROXY_IN_FLIGHT.set(queue.in_flight, proxy=proxy)
+        PROXY_QUEUED.set(queue.queued, proxy=proxy)
+        PROXY_BREAKER_STATE.set((ProxyBreaker.CLOSED, ProxyBreaker.HALF_OPEN, ProxyBreaker.OPEN).index(
+            queue.breaker.state), proxy=proxy)
+        PROXY_BREAKER_OPENS.set(queue.breaker.opens, proxy=proxy)
+        PROXY_BREAKER_REJECTED.set(queue.breaker.rejected, proxy=proxy)
+    for service, limiter in service_registry.limiters.items():
+        SERVICE_IN_FLIGHT.set(limiter.in_flight, service=service)
+        SERVICE_WAITING.set(len(limiter.waiters), service=service)
+        SERVICE_THROTTLED.set(limiter.throttled, service=service)
+    JOBS.values.clear()
+    for state, count in job_queue.stats().items():
+        if state != "workers":
+            JOBS.set(count, state=state)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def route_template(scope):
+    # metrics are labelled by route, raw paths carry job ids and whatever scanners try
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match != Match.NONE:
+            return route.path
+    return "unmatched"
 
 
 @app.middleware("http")
 async def capture_request_body(request: Request, call_next):
-    request.state.body = await request.body()
-    response = await call_next(request)
-    return response
+    endpoint = route_template(request.scope)
+    if endpoint == "/metrics":
+        request.state.body = await request.body()
+        return await call_next(request)
+    started = time.perf_counter()
+    outcome = "success"
+    REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+    try:
+        trace_id = request.headers.get("x-trace-id")
+        if trace_id is not None and not TRACE_ID_PATTERN.fullmatch(trace_id):
+            trace_id = None
+        with tracer.trace("request", trace_id, endpoint=request.url.path) as root:
+            request.state.trace_id = root.attributes["traceId"]
+            with trace_span("read_body"):
+                request.state.body = await request.body()
+            response = await call_next(request)
+            response.headers["X-Trace-Id"] = request.state.trace_id
+        return response
+    except Exception as e:
+        outcome = classify_exception(e)[0]
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        session_request = getattr(request.state, 'session_request', None)
+        service = (session_request.data.get("service") or "") if session_request is not None else ""
+        REQUESTS_TOTAL.inc(endpoint=endpoint, service=service, outcome=outcome)
+        REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint, service=service, outcome=outcome)
+
+
+def generate_usernames(first_name=None, last_name=None, count=None):
+    count = count or USERNAME_CANDIDATES
+    strategies = [
+        (first_name, last_name, None),
+        (first_name, last_name, [0, 99]),
+        (None, None, None),
+        (None, None, [1000, 100000000])
+    ]
+    candidates = {}
+    for attempt in range(count * 3):
+        try:
+            username = generate_username(*strategies[attempt % len(strategies)])
+        except Exception:
+            continue
+        candidates.setdefault(username.lower(), username)
+        if len(candidates) >= count:
+            break
+    return list(candidates.values())
 
 
 def generate_username(first_name=None, last_name=None, numbersRange=None):
@@ -985,6 +3233,341 @@ def generate_username(first_name=None, last_name=None, numbersRange=None):
     raise Exception("Bad username generated")
 
 
+class HashRing:
+    def __init__(self, size, replicas=64):
+        self.size = size
+        points = sorted((self.hash(f"{node}:{replica}"), node) for node in range(size) for replica in range(replicas))
+        self.keys = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    @staticmethod
+    def hash(value):
+        return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def owner(self, key) -> int:
+        position = bisect.bisect(self.keys, self.hash(str(key))) % len(self.keys)
+        return self.nodes[position]
+
+
+worker_index = 0
+worker_ring = None
+
+
+def session_shard(session_id) -> int:
+    if worker_ring is None:
+        return 0
+    return worker_ring.owner(session_id)
+
+
+class Dispatcher:
+    def __init__(self, sockets):
+        self.sockets = sockets
+        self.ring = HashRing(len(sockets))
+        self.next_worker = 0
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, limit=2 ** 20)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                except UnknownError as e:
+                    # the stream can not be trusted after a bad request, answer and close
+                    writer.write(self._response(e.status_code, json_dumps(
+                        {"status": "unknown_error", "detail": e.detail}), False))
+                    await writer.drain()
+                    return
+                try:
+                    keep_alive = await self._dispatch(writer, *request)
+                except ConnectionError:
+                    # the client went away, worker connection errors come as UnknownError
+                    return
+                except Exception as e:
+                    # the same JSON error a worker would have answered with
+                    response = exception_response(e, request[3].decode('utf-8', 'replace'))
+                    writer.write(self._response(response.status_code, bytes(response.body), False))
+                    await writer.drain()
+                    return
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except Exception as e:
+            logger.error(f"Dispatcher error: {e}")
+        finally:
+            writer.close()
+
+    async def _dispatch(self, writer, method, target, headers, body):
+        keep_alive = self._header(headers, 'connection', '').lower() != 'close'
+        path = target.split('?')[0]
+        if method == "POST" and path == "/api/batch":
+            await self._dispatch_batch(writer, headers, body)
+            return False
+        if method == "POST" and path == "/api/prewarm":
+            data = json_loads(body)
+            shards = {}
+            for item in data["items"]:
+                shards.setdefault(self.ring.owner(item.get("id")), []).append(item)
+            # warmUntil is absolute, so every worker keeps its clients until the same moment
+            if data.get("warmUntil") is None:
+                data["warmUntil"] = time.time() + float(data.get("warmFor") or PREWARM_DEFAULT_TTL)
+            concurrency = min(int(data.get("concurrency") or PREWARM_CONCURRENCY), BATCH_MAX_CONCURRENCY)
+            data["concurrency"] = max(1, -(-concurrency // len(self.sockets)))
+            for index, items in shards.items():
+                await self._forward(self.sockets[index], method, target, headers, json_dumps({**data, "items": items}))
+            writer.write(self._response(200, json_dumps({"status": "success", "sessions": len(data["items"])}),
+                                        keep_alive))
+            return keep_alive
+        if method == "GET" and path == "/metrics":
+            texts = [(await self._forward(socket, method, target, headers, body))[2].decode('utf-8')
+                     for socket in self.sockets]
+            writer.write(self._response(200, merge_metrics(texts).encode('utf-8'), keep_alive,
+                                        "text/plain; version=0.0.4"))
+            return keep_alive
+        if method == "GET" and path == "/api/stats":
+            workers = [json_loads((await self._forward(socket, method, target, headers, body))[2])
+                       for socket in self.sockets]
+            writer.write(self._response(200, json_dumps({"workers": workers}), keep_alive))
+            return keep_alive
+        status_code, response_headers, payload = await self._forward(self._route(path, body), method, target,
+                                                                     headers, body)
+        writer.write(self._response_head(status_code, response_headers, len(payload), keep_alive) + payload)
+        return keep_alive
+
+    def _route(self, path, body):
+        session_id = None
+        try:
+            data = json_loads(body) if body else None
+            if isinstance(data, dict):
+                session_id = data.get("id")
+                if session_id is None and path == "/api/jobs" and isinstance(data.get("payload"), dict):
+                    session_id = data["payload"].get("id")
+        except ValueError:
+            pass
+        if session_id is None:
+            self.next_worker = (self.next_worker + 1) % len(self.sockets)
+            return self.sockets[self.next_worker]
+        return self.sockets[self.ring.owner(session_id)]
+
+    async def _dispatch_batch(self, writer, headers, body):
+        data = json_loads(body)
+        if data.get("operation") not in operation_map:
+            status_code, response_headers, payload = await self._forward(self.sockets[0], "POST", "/api/batch",
+                                                                         headers, body)
+            writer.write(self._response_head(status_code, response_headers, len(payload), False) + payload)
+            return
+        concurrency = min(int(data.get("concurrency") or BATCH_DEFAULT_CONCURRENCY), BATCH_MAX_CONCURRENCY)
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        target = f"/api/{data['operation']}"
+
+        async def run_item(index, item):
+            if "timeout" in data and "timeout" not in item:
+                item = {**item, "timeout": data["timeout"]}
+            raw = json_dumps(item)
+            async with semaphore:
+                try:
+                    socket = self.sockets[self.ring.owner(item.get("id"))]
+                    _, _, payload = await self._forward(socket, "POST", target, headers, raw)
+                    content = json_loads(payload) or {"status": "success"}
+                except Exception as e:
+                    detail = e.detail if isinstance(e, UnknownError) else str(e)
+                    content = {"status": "unknown_error", "detail": f"Worker failed: {detail}",
+                               "data": raw.decode('utf-8')}
+            return json_dumps({"index": index, "id": item.get("id"), **content}) + b"\n"
+
+        items = list(enumerate(data["items"]))
+        # nothing below can fail before the items are running, errors after the head only end the stream
+        tasks = [asyncio.create_task(run_item(index, item)) for index, item in items]
+        writer.write(b"HTTP/1.1 200 OK\r\ncontent-type: application/x-ndjson\r\n"
+                     b"transfer-encoding: chunked\r\nconnection: close\r\n\r\n")
+        try:
+            for task in asyncio.as_completed(tasks):
+                line = await task
+                writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _forward(self, socket, method, target, headers, body):
+        for attempt in range(50):
+            try:
+                reader, writer = await asyncio.open_unix_connection(socket, limit=2 ** 20)
+                break
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                # the worker is still starting or being restarted
+                if attempt == 49:
+                    raise UnknownError(502, f"Worker unavailable: {e}")
+                await asyncio.sleep(0.1)
+        try:
+            skip = ('connection', 'content-length', 'transfer-encoding', 'keep-alive')
+            lines = [f"{method} {target} HTTP/1.1"]
+            lines += [f"{name}: {value}" for name, value in headers if name.lower() not in skip]
+            lines += [f"content-length: {len(body)}", "connection: close", "", ""]
+            writer.write("\r\n".join(lines).encode('latin-1') + body)
+            lines = (await reader.readuntil(b"\r\n\r\n")).decode('latin-1').split("\r\n")[:-2]
+            status_code = int(lines[0].split(" ", 2)[1])
+            headers = [tuple(part.strip() for part in line.split(":", 1)) for line in lines[1:]]
+            length = self._header(headers, 'content-length')
+            if self._header(headers, 'transfer-encoding', '').lower() == 'chunked':
+                payload = await self._read_chunked(reader)
+            elif length is not None:
+                payload = await reader.readexactly(int(length))
+            else:
+                payload = await reader.read()
+            return status_code, headers, payload
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            raise UnknownError(502, f"Worker failed: {e}")
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if not size:
+                # trailers end with an empty line
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    @staticmethod
+    async def _read_request(reader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise UnknownError(431, "Request head too large")
+        lines = head.decode('latin-1').split("\r\n")[:-2]
+        request_line = lines[0].split(" ")
+        if len(request_line) != 3 or not request_line[2].startswith("HTTP/1."):
+            raise UnknownError(400, "Malformed request line")
+        if any(":" not in line for line in lines[1:]):
+            raise UnknownError(400, "Malformed header")
+        headers = [tuple(part.strip() for part in line.split(":", 1)) for line in lines[1:]]
+        # bodies are only framed by content-length here, anything else would desync the connection
+        if Dispatcher._header(headers, 'transfer-encoding') is not None:
+            raise UnknownError(411, "Chunked request bodies are not supported, send content-length")
+        lengths = {value for key, value in headers if key.lower() == 'content-length'}
+        if len(lengths) > 1 or not all(length.isdigit() for length in lengths):
+            raise UnknownError(400, "Invalid content-length")
+        length = int(lengths.pop()) if lengths else 0
+        body = await reader.readexactly(length) if length else b""
+        return request_line[0], request_line[1], headers, body
+
+    @staticmethod
+    def _header(headers, name, default=None):
+        return next((value for key, value in headers if key.lower() == name), default)
+
+    @staticmethod
+    def _response_head(status_code, headers, length, keep_alive):
+        # framing is ours, the worker always answers a connection that closes
+        skip = ('connection', 'content-length', 'transfer-encoding', 'keep-alive')
+        try:
+            phrase = http.HTTPStatus(status_code).phrase
+        except ValueError:
+            phrase = ""
+        lines = [f"HTTP/1.1 {status_code} {phrase}"]
+        lines += [f"{name}: {value}" for name, value in headers if name.lower() not in skip]
+        if status_code not in (204, 304):
+            lines.append(f"content-length: {length}")
+        lines += [f"connection: {'keep-alive' if keep_alive else 'close'}", "", ""]
+        return "\r\n".join(lines).encode('latin-1')
+
+    @classmethod
+    def _response(cls, status_code, body, keep_alive, content_type="application/json"):
+        return cls._response_head(status_code, [("content-type", content_type)], len(body), keep_alive) + body
+
+
+def merge_metrics(texts):
+    families = OrderedDict()
+    for worker, text in enumerate(texts):
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                family = line.split(" ", 3)[2]
+                header = families.setdefault(family, ([], []))[0]
+                if line not in header:
+                    header.append(line)
+            elif line:
+                name, _, rest = line.partition("{")
+                if rest:
+                    line = f'{name}{{worker="{worker}",{rest}'
+                else:
+                    name, _, value = line.partition(" ")
+                    line = f'{name}{{worker="{worker}"}} {value}'
+                families.setdefault(family, ([], []))[1].append(line)
+    return "\n".join(line for header, samples in families.values() for line in header + samples) + "\n"
+
+
+def run_worker(index, socket, workers, log_config):
+    global worker_index, worker_ring
+    import uvicorn
+
+    worker_index = index
+    worker_ring = HashRing(workers)
+    # per-process limits, the totals stay what was configured for the whole service
+    client_pool.max_size = max(1, -(-client_pool.max_size // workers))
+    proxy_scheduler.max_in_flight = max(1, -(-proxy_scheduler.max_in_flight // workers))
+    service_registry.workers = workers
+    service_registry.apply_limits()
+    # RotatingFileHandler is not safe to share between processes
+    tracer.path = f"{tracer.path}.{index}"
+    if os.path.exists(socket):
+        os.remove(socket)
+    uvicorn.run(app, uds=socket, log_config=log_config)
+
+
+def run_prefork(host, port, workers, log_config):
+    # everything heavy is imported at module level, forked workers share it copy-on-write
+    gc.freeze()
+    context = multiprocessing.get_context("fork")
+    sockets = [os.path.join(tempfile.gettempdir(), f"telegram-session-service-{port}-{index}.sock")
+               for index in range(workers)]
+    processes = [None] * workers
+
+    def spawn(index):
+        processes[index] = context.Process(target=run_worker, args=(index, sockets[index], workers, log_config),
+                                           daemon=True)
+        processes[index].start()
+
+    async def supervise():
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    spawn(index)
+
+    async def serve():
+        supervisor = asyncio.create_task(supervise())
+        try:
+            await Dispatcher(sockets).serve(host, port)
+        finally:
+            supervisor.cancel()
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    for index in range(workers):
+        spawn(index)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(5)
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1025,7 +3608,65 @@ if __name__ == "__main__":
     }
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=5000, help='Порт для запуска')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Количество процессов-воркеров, сессии распределяются между ними')
+    parser.add_argument('--pool-size', type=int, default=CLIENT_POOL_MAX_SIZE,
+                        help='Максимум подключенных клиентов в пуле')
+    parser.add_argument('--pool-ttl', type=int, default=CLIENT_POOL_IDLE_TTL,
+                        help='Время жизни простаивающего клиента в пуле, сек')
+    parser.add_argument('--account-store', type=str, default=ACCOUNT_STORE_PATH,
+                        help='Файл SQLite с кешем данных аккаунтов')
+    parser.add_argument('--session-store', type=str, default=SESSION_STORE_PATH,
+                        help='Файл SQLite, в котором хранятся все сессии')
+    parser.add_argument('--session-write-behind', action='store_true',
+                        help='Держать сессии в памяти и сбрасывать изменения на диск пачками в фоне')
+    parser.add_argument('--session-flush-interval', type=float, default=SESSION_FLUSH_INTERVAL,
+                        help='Интервал сброса сессий на диск в режиме write-behind, сек')
+    parser.add_argument('--migrate-directory', type=str, action='append', default=[],
+                        help='Перенести сессии из каталога в двухуровневую структуру при старте, можно указать несколько')
+    parser.add_argument('--import-directory', type=str,
+                        help='Импортировать все .session и tdata из каталога в хранилище сессий и выйти')
+    parser.add_argument('--import-processes', type=int, default=os.cpu_count(),
+                        help='Количество процессов для разбора сессий при импорте')
+    parser.add_argument('--webview-max-age', type=float, default=WEBVIEW_CACHE_MAX_AGE,
+                        help='Сколько секунд после auth_date отдавать tgWebAppData из кеша')
+    parser.add_argument('--services', type=str, default=SERVICES_PATH,
+                        help='JSON с описанием сервисов и их лимитов, изменения подхватываются без перезапуска')
+    parser.add_argument('--job-store', type=str, default=JOB_STORE_PATH,
+                        help='Файл SQLite с очередью задач')
+    parser.add_argument('--job-workers', type=int, default=JOB_WORKERS,
+                        help='Количество воркеров очереди задач')
+    parser.add_argument('--proxy-concurrency', type=int, default=PROXY_MAX_IN_FLIGHT,
+                        help='Максимум одновременных подключений через один прокси')
+    parser.add_argument('--slow-trace-threshold', type=float, default=TRACE_SLOW_THRESHOLD,
+                        help='Запросы дольше этого времени, сек, записываются в лог трейсов')
+    parser.add_argument('--slow-trace-log', type=str, default=TRACE_LOG_PATH,
+                        help='Файл лога медленных трейсов')
     args = parser.parse_args()
+    client_pool.max_size = args.pool_size
+    client_pool.idle_ttl = args.pool_ttl
+    account_store.path = args.account_store
+    session_store.path = args.session_store
+    session_store.write_behind = args.session_write_behind
+    session_store.flush_interval = args.session_flush_interval
+    layout_migrator.startup_directories = args.migrate_directory
+    webview_cache.max_age = args.webview_max_age
+    service_registry.path = args.services
+    # ошибка в конфиге сервисов видна сразу при старте
+    service_registry.reload()
+    if args.import_directory:
+        # разовый импорт, сервер не запускается
+        failed = import_accounts(args.import_directory, args.import_processes, IMPORT_BATCH_SIZE)
+        raise SystemExit(1 if failed else 0)
+    job_queue.path = args.job_store
+    job_queue.workers = args.job_workers
+    proxy_scheduler.max_in_flight = args.proxy_concurrency
+    tracer.path = args.slow_trace_log
+    tracer.slow_threshold = args.slow_trace_threshold
     logger.info(f"Started 127.0.0.1:{args.port}")
-    # Запуск uvicorn с кастомной конфигурацией логирования
-    uvicorn.run(app, host="127.0.0.1", port=args.port, log_config=log_config)
+    if args.workers > 1:
+        # Диспетчер на порту, сессии распределены по воркерам
+        run_prefork("127.0.0.1", args.port, args.workers, log_config)
+    else:
+        # Запуск uvicorn с кастомной конфигурацией логирования
+        uvicorn.run(app, host="127.0.0.1", port=args.port, log_config=log_config)
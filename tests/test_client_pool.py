@@ -0,0 +1,90 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeClient:
+    def __init__(self, ping_delay=0):
+        self.connected = True
+        self.ping_delay = ping_delay
+        self.pings = 0
+
+    def is_connected(self):
+        return self.connected
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def __call__(self, request):
+        self.pings += 1
+        await asyncio.sleep(self.ping_delay)
+        return request
+
+
+def session_data(session_id=1):
+    return {"id": session_id, "proxy": None, "sessionType": "telethon", "apiJson": None}
+
+
+def make_pool(clients):
+    pool = main.ClientPool(max_size=4, idle_ttl=300, health_check_after=60)
+
+    async def connect(data, proxy_dict):
+        return clients.pop(0)
+
+    pool._connect = connect
+    return pool
+
+
+def test_sweep_does_not_close_entry_during_health_check():
+    async def scenario():
+        client = FakeClient(ping_delay=0.1)
+        pool = make_pool([client])
+        data = session_data()
+        assert await pool.acquire(data, None) == (client, True)
+        await pool.release(data, client, True)
+        pool.entries[pool.key(data)].last_used = time.monotonic() - 310
+
+        acquired, _ = await asyncio.gather(pool.acquire(data, None), pool.sweep())
+        assert acquired == (client, False)
+        assert client.pings == 1
+        assert client.is_connected()
+        assert pool.entries[pool.key(data)].users == 1
+
+    asyncio.run(scenario())
+
+
+def test_failed_health_check_replaces_client():
+    async def scenario():
+        stale, fresh = FakeClient(), FakeClient()
+        pool = make_pool([stale, fresh])
+        data = session_data()
+        await pool.acquire(data, None)
+        await pool.release(data, stale, True)
+        stale.connected = False
+
+        assert await pool.acquire(data, None) == (fresh, True)
+        assert pool.health_check_failures == 1
+
+    asyncio.run(scenario())
+
+
+def test_dropped_client_is_closed_by_last_borrower():
+    async def scenario():
+        client = FakeClient()
+        pool = make_pool([client])
+        data = session_data()
+        borrowed = [(await pool.acquire(data, None))[0] for _ in range(3)]
+
+        await pool.release(data, borrowed[0], False)
+        await pool.release(data, borrowed[1], True)
+        assert client.is_connected()
+        await pool.release(data, borrowed[2], True)
+        assert not client.is_connected()
+        assert not pool.retired
+
+    asyncio.run(scenario())